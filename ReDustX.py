@@ -1,16 +1,27 @@
 # -*- coding: utf-8 -*-
+import array
+import astc_encoder
 import base64
-import fnmatch
+import gc
+import hashlib
 import json
+import multiprocessing
 import os
+import queue
 import re
 import requests
 import shutil
+import sqlite3
 import struct
 import sys
+import tempfile
 import UnityPy
+import threading
+import time
 import webbrowser
 import subprocess
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from InquirerPy import prompt
 from PIL import Image, ImageFile
 from tqdm import tqdm
@@ -18,6 +29,7 @@ from json_to_skel import json_to_skel
 from pathlib import Path
 
 import maintenance_info_pb2
+import unityfs
 
 RDXVersion = '1.0.1'
 UnityPy.config.FALLBACK_UNITY_VERSION = '2022.3.22f1'
@@ -52,9 +64,55 @@ astc_encoder_binary_path = next((p for p in _astc_candidates if p.exists()), _as
 astc_encode_tmp_folder = "tmp/"
 astc_encode_tmp_folder_path = base_path.joinpath(astc_encode_tmp_folder)
 
+texture_cache_folder = "texture_cache/"
+texture_cache_folder_path = base_path.joinpath(texture_cache_folder)
+
+# astcenc options that change the encoded output, the in-process encoder follows them too
+astc_encode_flags = ["-medium", "-yflip", "-decode_unorm8"]
+
+# "astcenc" runs the astcenc program, "astc_encoder" encodes in-process with astc-encoder-py
+texture_encoder_backend = "astcenc"
+
+cdn_base_url = "https://cdn.bd2.pmang.cloud/ServerData/Android"
+maintenance_info_cache_path = base_path.joinpath("maintenance_info.json")
+container_index_path = base_path.joinpath("bundle_containers.db")
+build_manifest_path = base_path.joinpath("build_manifest.json")
+build_manifest_version = 1  # Bump when a code change alters the repacked bundles, so they are all rebuilt once
+
+# Network settings
+maintenance_cache_ttl = 3600  # Seconds before the game versions are asked again
+offline_mode = False  # Always repack from the local catalog and bundles
+
+# Performance settings
+download_workers = 8
+parse_workers = None  # Processes used to parse bundles, None uses every CPU core
+header_only_scan = True  # List bundle contents without decompressing texture data
+memory_mapped_bundles = True  # Load bundles from a memory-mapped view of __data instead of copying them into memory
+repack_workers = None  # Processes used to repack bundles, None uses every CPU core
+astc_encode_jobs = None  # astcenc processes running at the same time, None splits the CPU cores with astc_encode_threads
+astc_encode_threads = None  # Threads of each astcenc process (-j), None splits the CPU cores with astc_encode_jobs
+astc_encode_ram_tmp = True  # Write astcenc output to /dev/shm when available instead of tmp/
+pipelined_repack = True
+pipeline_queue_size = 2
+environment_cache_size = 4  # Parsed bundles kept in memory between matching and repacking, only when the staged repack loads them in this process
+repack_memory_budget_mb = None  # RAM for the bundles being repacked at once, None doesn't limit it
+
+# Compression of the repacked bundles: "lz4" is the format the game ships, "lz4fast" writes it much faster
+# but a little bigger, "lz4hc" marks the blocks as LZ4HC, "lzma" is the smallest, "none" skips it
+bundle_packer = "lz4"
+bundle_compress_threads = None  # Threads compressing the blocks of a bundle with the lz4 packers, None splits the CPU cores between the repack workers
+preserve_original_blocks = True  # Copy the blocks a repack didn't change from the original bundle instead of compressing them again (lz4 packers only)
+
+# Disk space used by encoded textures, least recently used ones are removed past it (0 disables the cache)
+texture_cache_size_mb = 512
+
+# Disk space used by downloaded bundles, least recently used ones are removed past it (None keeps everything)
+bundle_cache_budget_gb = 10
+
 skeleton_data_bundles_paths = []
+bundle_store_names = {}
 
-def get_cdn_version(quality):
+def fetch_maintenance_info():
     url = "https://mt.bd2.pmang.cloud/MaintenanceInfo"
 
     # Define the headers
@@ -67,45 +125,98 @@ def get_cdn_version(quality):
         'user-agent': 'UnityPlayer/2022.3.22f1 (UnityWebRequest/1.0, libcurl/8.5.0-DEV)',
     }
     data = 'EAQ='
-    response = requests.put(url, headers=headers, data=data)
+    response = requests.put(url, headers=headers, data=data, timeout=30)
 
-    base64_data = response.json()['data']
+    return response.json()['data']
+
+def decode_maintenance_info(base64_data):
     binary_data = base64.b64decode(base64_data)
 
     response = maintenance_info_pb2.MaintenanceInfoResponse()  # Change type if needed
     response.ParseFromString(binary_data)
 
+    return response
+
+def load_maintenance_info_cache():
+    try:
+        with open(maintenance_info_cache_path, "r") as f:
+            cache = json.load(f)
+        return cache['fetched_at'], decode_maintenance_info(cache['data'])
+    except Exception:
+        return None
+
+def save_maintenance_info_cache(base64_data):
+    tmp_path = maintenance_info_cache_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({'fetched_at': time.time(), 'data': base64_data}, f)
+    os.replace(tmp_path, maintenance_info_cache_path)
+
+def get_maintenance_info():
+    cache = load_maintenance_info_cache()
+    if cache and 0 <= time.time() - cache[0] < maintenance_cache_ttl:
+        return cache[1]
+
+    try:
+        base64_data = fetch_maintenance_info()
+        response = decode_maintenance_info(base64_data)
+    except Exception:
+        if cache is None:
+            raise
+        # An outdated answer is still better than no repack at all
+        print(" \033[33mCould not reach the maintenance server, using the last known game version.\033[0m")
+        return cache[1]
+
+    save_maintenance_info_cache(base64_data)
+    return response
+
+def get_bundle_version(response, quality):
     return response.market_info.bundle_version if quality == 'HD' else response.market_info.bundle_version_sd
 
-def download_catalog(quality, version):
+def get_cdn_version(quality):
+    return get_bundle_version(get_maintenance_info(), quality)
+
+def get_local_cdn_version(quality):
+    # Only the last known version of this quality, a catalog of the other quality or an older
+    # version would repack bundles the game doesn't load
+    cache = load_maintenance_info_cache()
+    if not cache:
+        return None
+    version = get_bundle_version(cache[1], quality)
+    if base_path.joinpath(f"catalog_{version}.json").exists() or get_catalog_index_path(version).exists():
+        return version
+    return None
+
+def download_catalog(quality, version, offline=False):
     # Define the filename based on the quality
     filename = base_path.joinpath(f"catalog_{version}.json")
 
     # Check if the file exists in the current directory
     if filename.exists():
+        if not get_catalog_index_path(version).exists():
+            print(" Indexing catalog...")
+            build_catalog_index(version, quality)
         return 0
-    
-    pattern = 'catalog_*.json'
-    for root, dirs, files in os.walk(base_path):
-        for file in files:
-            if fnmatch.fnmatch(file, pattern):
-                file_path = Path(root).joinpath(file)
-                try:
-                    os.remove(file_path)
-                except:
-                    pass
-        break
 
+    if offline:
+        return 0 if get_catalog_index_path(version).exists() else -1
+    
     # Define the download URL
-    url = f"https://cdn.bd2.pmang.cloud/ServerData/Android/{quality}/{version}/catalog_alpha.json"
+    url = f"{cdn_base_url}/{quality}/{version}/catalog_alpha.json"
     
     # Download the file
     print(" Downloading new catalog...")
-    response = requests.get(url)
+    try:
+        response = requests.get(url, timeout=60)
+    except requests.RequestException:
+        return -1
 
     if response.status_code == 200:
+        # Old catalogs are only dropped by clean_old_catalogs once the new one is here, offline repacks rely on them
         with open(filename, 'wb') as file:
             file.write(response.content)
+
+        print(" Indexing catalog...")
+        build_catalog_index(version, quality)
         return 1
     else:
         return -1
@@ -122,8 +233,14 @@ class SerializationUtilities:
         Type = 6
         JsonObject = 7
         
-def read_int32_from_byte_array(byte_array, offset):
-    return struct.unpack_from('<i', byte_array, offset)[0]
+def view_int32_array(byte_array):
+    # Little-endian int32 view over the whole buffer, only copied on big-endian hosts
+    view = memoryview(byte_array)[:len(byte_array) // 4 * 4].cast('i')
+    if sys.byteorder != 'little':
+        values = array.array('i', view)
+        values.byteswap()
+        return memoryview(values)
+    return view
 
 def read_object_from_byte_array(key_data, data_index):
     try:
@@ -162,160 +279,657 @@ def read_object_from_byte_array(key_data, data_index):
 
     return None
 
-def parse_catalog(version, required_assets):
+class LazyKeyTable:
+    # Catalog keys decoded on first access instead of all up front
+    def __init__(self, key_data, data_offsets):
+        self.key_data = key_data
+        self.data_offsets = data_offsets
+        self.keys = {}
+
+    def __len__(self):
+        return len(self.data_offsets)
+
+    def __getitem__(self, index):
+        if index not in self.keys:
+            self.keys[index] = read_object_from_byte_array(self.key_data, self.data_offsets[index])
+        return self.keys[index]
+
+    def basename(self, index):
+        # Lower-cased asset basename of a key, only slicing the basename bytes of ASCII keys
+        data_index = self.data_offsets[index]
+        if self.key_data[data_index] != SerializationUtilities.ObjectType.AsciiString:
+            return str(self[index]).lower().rstrip('/').rpartition('/')[2]
+
+        start = data_index + 5
+        end = start + struct.unpack_from('<i', self.key_data, data_index + 1)[0]
+        while end > start and self.key_data[end - 1] == 0x2F:
+            end -= 1
+        start = max(self.key_data.rfind(b'/', start, end) + 1, start)
+        return self.key_data[start:end].decode('ascii').lower()
+
+class LazyBundleTable:
+    # Bundle request options read from the extra data only for bundles that are actually resolved
+    def __init__(self, extra_data, keys, bundle_entries):
+        self.extra_data = extra_data
+        self.keys = keys
+        self.bundle_entries = bundle_entries
+        self.bundles = {}
+
+    def __contains__(self, entry_index):
+        return entry_index in self.bundle_entries
+
+    def __getitem__(self, entry_index):
+        if entry_index not in self.bundles:
+            extra_offset, key_index = self.bundle_entries[entry_index]
+            temp_data = read_object_from_byte_array(self.extra_data, extra_offset)
+            raw_key = self.keys[key_index] if key_index < len(self.keys) else ''
+            self.bundles[entry_index] = (temp_data['m_BundleName'], temp_data['m_Hash'], temp_data['m_BundleSize'], str(raw_key))
+        return self.bundles[entry_index]
+
+def get_catalog_index_path(version):
+    return base_path.joinpath(f"catalog_{version}.db")
+
+def read_catalog_assets(version, required_assets=None):
     catalog = base_path.joinpath(f"catalog_{version}.json")
-
-    required_assets = {asset.lower() for asset in (required_assets or [])}
-    asset_hits = {}
-    bundle_names = set()
-    resolved_paths = set()
+    # When given, only assets whose basename is required are decoded and resolved
+    required_assets = {asset.lower() for asset in required_assets} if required_assets is not None else None
 
     with open(catalog, 'r', encoding='utf-8') as file:
         data = json.load(file)
 
     # Decode base64 data for bucket data
     bucket_array = base64.b64decode(data['m_BucketDataString'])
-    num_buckets = struct.unpack_from('<i', bucket_array, 0)[0]  # Read number of buckets
-    dependency_map = [None] * num_buckets
-    data_offsets = []
-    index = 4
-
-    for i in range(num_buckets):
-        data_offset = read_int32_from_byte_array(bucket_array, index)
-        index += 4
-        num_entries = read_int32_from_byte_array(bucket_array, index)
-        index += 4
-        entries = []
-        for _ in range(num_entries):
-            entry_index = read_int32_from_byte_array(bucket_array, index)
-            index += 4
-            entries.append(entry_index)
-        data_offsets.append(data_offset)
-        dependency_map[i] = entries
-
-    key_array = base64.b64decode(data['m_KeyDataString'])
-    keys = [None] * len(data_offsets)
-    for idx, offset in enumerate(data_offsets):
-        keys[idx] = read_object_from_byte_array(key_array, offset)
+    bucket_ints = view_int32_array(bucket_array)
+    num_buckets = bucket_ints[0]  # Read number of buckets
+    data_offsets = [0] * num_buckets
+    index = 1
 
+    keys = LazyKeyTable(base64.b64decode(data['m_KeyDataString']), data_offsets)
     extra_data = base64.b64decode(data['m_ExtraDataString'])
     entry_data = base64.b64decode(data['m_EntryDataString'])
-    number_of_entries = read_int32_from_byte_array(entry_data, 0)
-    index = 4
+    del data
+
+    # Entries are fixed 7 x int32 records, so every field is a strided column of the same view
+    entry_ints = view_int32_array(entry_data)
+    number_of_entries = entry_ints[0]
+    entry_table = entry_ints[1:1 + number_of_entries * 7]
+    providers = entry_table[1::7].tolist()
+    dependency_indices = entry_table[2::7].tolist()
+    extra_offsets = entry_table[4::7].tolist()
+    key_indices = entry_table[5::7].tolist()
+    num_keys = len(keys)
+
+    bundle_entries = {
+        m: (extra_offset, key_indices[m])
+        for m, (provider, extra_offset) in enumerate(zip(providers, extra_offsets))
+        if provider == 1 and extra_offset >= 0
+    }
+    bundles = LazyBundleTable(extra_data, keys, bundle_entries)
 
-    bundles = {}
-    entries = []
+    # Buckets are variable length records: data offset, entry count, entry indices.
+    # Each one is resolved to its first bundle entry straight from the view.
+    bucket_bundles = [None] * num_buckets
+    for i in range(num_buckets):
+        num_entries = bucket_ints[index + 1]
+        data_offsets[i] = bucket_ints[index]
+        for dep_entry in bucket_ints[index + 2:index + 2 + num_entries]:
+            if dep_entry in bundle_entries:
+                bucket_bundles[i] = dep_entry
+                break
+        index += 2 + num_entries
+
+    # Resolve every entry to its bundle through its dependency bucket in one pass
+    entry_bundles = [
+        m if m in bundle_entries else (bucket_bundles[dep_idx] if 0 <= dep_idx < num_buckets else None)
+        for m, dep_idx in enumerate(dependency_indices)
+    ]
 
-    for m in range(number_of_entries):
-        #num1 = read_int32_from_byte_array(entry_data, index)
-        index += 4
-        num2 = read_int32_from_byte_array(entry_data, index)
-        index += 4
-        num3 = read_int32_from_byte_array(entry_data, index)
-        index += 4
-        #num4 = read_int32_from_byte_array(entry_data, index)
-        index += 4
-        num5 = read_int32_from_byte_array(entry_data, index)
-        index += 4
-        num6 = read_int32_from_byte_array(entry_data, index)
-        index += 4
-        #num7 = read_int32_from_byte_array(entry_data, index)
-        index += 4
-
-        entries.append({ 'dependency_index': num3 })
-
-        raw_key = keys[num6] if num6 < len(keys) else ''
-        key = str(raw_key).lower()
-
-        if num2 == 1 and num5 >= 0:
-            temp_data = read_object_from_byte_array(extra_data, num5)
-            bundle_path = asset_bundles_folder_path.joinpath(temp_data['m_BundleName'], temp_data['m_Hash'], '__data')
-            bundles[m] = {
-                'bundle_name': temp_data['m_BundleName'],
-                'path': str(bundle_path),
-                'bundle_key': str(raw_key),
-                'size': temp_data['m_BundleSize']
-            }
+    # Only the first entry of an asset name is ever used
+    asset_hits = {}
+    for m, key_index in enumerate(key_indices):
+        if m in bundle_entries or key_index >= num_keys:
+            continue
+        if required_assets is None:
+            raw_key = str(read_object_from_byte_array(keys.key_data, data_offsets[key_index]))
+            asset_name = raw_key.lower().rstrip('/').rpartition('/')[2]
+        else:
+            # Cheap basename pre-filter, the full key is only decoded for required assets
+            asset_name = keys.basename(key_index)
+            raw_key = None
+        if not asset_name or asset_name in asset_hits:
             continue
+        if required_assets is not None:
+            if asset_name not in required_assets:
+                continue
+            raw_key = str(keys[key_index])
+        asset_hits[asset_name] = (raw_key, entry_bundles[m])
+
+    used_bundles = {bundle_index: bundles[bundle_index] for _, bundle_index in asset_hits.values() if bundle_index is not None}
+    return asset_hits, used_bundles
 
-        if not key or not required_assets:
+def build_catalog_index(version, quality):
+    index_path = get_catalog_index_path(version)
+    asset_hits, bundles = read_catalog_assets(version)
+
+    # Write to a temporary file first so an interrupted build never leaves a half-filled index behind
+    tmp_index_path = index_path.with_suffix(".db.tmp")
+    if tmp_index_path.exists():
+        os.remove(tmp_index_path)
+
+    connection = sqlite3.connect(tmp_index_path)
+    try:
+        connection.execute("CREATE TABLE bundles (id INTEGER PRIMARY KEY, name TEXT NOT NULL, hash TEXT NOT NULL, size INTEGER NOT NULL, key TEXT NOT NULL)")
+        connection.execute("CREATE TABLE assets (name TEXT PRIMARY KEY, key TEXT NOT NULL, bundle_id INTEGER) WITHOUT ROWID")
+        # HD and SD catalogs live side by side, each index remembers which one it belongs to
+        connection.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        connection.execute("INSERT INTO info (key, value) VALUES ('quality', ?)", (quality,))
+        connection.executemany(
+            "INSERT INTO bundles (id, name, hash, size, key) VALUES (?, ?, ?, ?, ?)",
+            ((m, *info) for m, info in bundles.items())
+        )
+        connection.executemany(
+            "INSERT INTO assets (name, key, bundle_id) VALUES (?, ?, ?)",
+            ((asset_name, raw_key, bundle_index) for asset_name, (raw_key, bundle_index) in asset_hits.items())
+        )
+        connection.commit()
+    finally:
+        connection.close()
+
+    os.replace(tmp_index_path, index_path)
+
+def lookup_catalog_assets(version, required_assets):
+    index_path = get_catalog_index_path(version)
+    required_assets = sorted({asset.lower() for asset in (required_assets or [])})
+    asset_infos = {}
+
+    def add_asset_info(asset_name, bundle_name, bundle_hash, bundle_size, bundle_key):
+        # Bundles are stored by hash so HD and SD share a single cache
+        bundle_path = asset_bundles_folder_path.joinpath(bundle_hash, '__data')
+        asset_infos[asset_name] = {
+            'bundle_name': bundle_name,
+            'hash': bundle_hash,
+            'path': str(bundle_path),
+            'bundle_key': bundle_key,
+            'size': bundle_size
+        }
+
+    # Without an index only the required assets are resolved straight from the catalog
+    if not index_path.exists():
+        asset_hits, bundles = read_catalog_assets(version, required_assets)
+        for asset_name, (_, bundle_index) in asset_hits.items():
+            if bundle_index is not None:
+                add_asset_info(asset_name, *bundles[bundle_index])
+        return asset_infos
+
+    connection = sqlite3.connect(f"file:{index_path.as_posix()}?mode=ro", uri=True)
+    try:
+        # Query in chunks to stay below SQLite's host parameter limit
+        for start in range(0, len(required_assets), 500):
+            chunk = required_assets[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = connection.execute(
+                f"SELECT a.name, b.name, b.hash, b.size, b.key FROM assets a JOIN bundles b ON b.id = a.bundle_id WHERE a.name IN ({placeholders})",
+                chunk
+            )
+            for row in rows:
+                add_asset_info(*row)
+    finally:
+        connection.close()
+
+    return asset_infos
+
+def create_http_session(pool_size):
+    # One keep-alive connection per worker, shared by every request of the session
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def get_bundle_download_name(info):
+    download_name = info['bundle_key'] or Path(info['path']).name
+    return re.sub(r'_[a-f0-9]+(?=\.bundle)', '', download_name)
+
+def is_bundle_downloaded(info):
+    # A bundle is only complete if it has the size the catalog announces
+    try:
+        size = Path(info['path']).stat().st_size
+    except OSError:
+        return False
+    return not info['size'] or size == info['size']
+
+def verify_bundle_file(file_path, expected_size):
+    size = file_path.stat().st_size
+    if expected_size and size != expected_size:
+        raise Exception(f"Size mismatch: expected {expected_size} bytes, got {size}")
+
+    with open(file_path, 'rb') as file:
+        signature = file.read(8)
+    if not signature.startswith(b"UnityFS\0"):
+        raise Exception("Downloaded file is not a Unity asset bundle")
+
+def download_bundle(session, url, info, on_progress):
+    bundle_path = Path(info['path'])
+    part_path = bundle_path.with_name(bundle_path.name + ".part")
+    bundle_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Resume from whatever an interrupted run left in the temporary file
+    offset = part_path.stat().st_size if part_path.exists() else 0
+    if info['size'] and offset > info['size']:
+        part_path.unlink()
+        offset = 0
+
+    headers = {'Range': f"bytes={offset}-"} if offset else {}
+    response = session.get(url, stream=True, timeout=60, headers=headers)
+    try:
+        if response.status_code == 416 and offset == info['size']:
+            # Everything was already downloaded, only the verification is left
+            pass
+        else:
+            response.raise_for_status()
+            if offset and response.status_code != 206:
+                # The server ignored the range, start over
+                offset = 0
+
+            on_progress(offset)
+            with open(part_path, 'ab' if offset else 'wb') as file:
+                for chunk in response.iter_content(chunk_size=1024 * 64):
+                    if chunk:
+                        file.write(chunk)
+                        on_progress(len(chunk))
+    finally:
+        response.close()
+
+    try:
+        verify_bundle_file(part_path, info['size'])
+    except Exception:
+        part_path.unlink(missing_ok=True)
+        raise
+
+    os.replace(part_path, bundle_path)
+
+def download_bundles(quality, version, infos, workers=None, base_url=None, on_complete=None, position=None):
+    workers = max(1, workers or download_workers)
+    base_url = base_url or cdn_base_url
+
+    failed = {}
+    progress_lock = threading.Lock()
+    with create_http_session(workers) as session:
+        with tqdm(desc=" Downloading bundles...", ascii=" ##########", bar_format="{desc} {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt}", colour="green", total=sum(info['size'] for info in infos), unit="B", unit_scale=True, position=position) as pbar:
+            def on_progress(size):
+                with progress_lock:
+                    pbar.update(size)
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {}
+                for info in infos:
+                    url = f"{base_url}/{quality}/{version}/{get_bundle_download_name(info)}"
+                    futures[executor.submit(download_bundle, session, url, info, on_progress)] = info
+
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        failed[futures[future]['path']] = e
+                        continue
+                    if on_complete:
+                        on_complete(futures[future])
+
+    return failed
+
+def resolve_catalog_bundles(version, required_assets):
+    asset_infos = lookup_catalog_assets(version, required_assets)
+
+    # One entry per bundle, in the order the assets were resolved
+    bundle_infos = {}
+    for asset_name in sorted(asset_infos):
+        info = asset_infos[asset_name]
+        bundle_infos.setdefault(info['path'], info)
+
+    for bundle_path, info in bundle_infos.items():
+        bundle_store_names[bundle_path] = info['bundle_name']
+        touch_file(bundle_path)
+
+    return bundle_infos
+
+def report_failed_downloads(failed, bundle_infos):
+    if not failed:
+        return
+
+    print(" \033[33mCould not download the following bundles:\033[0m")
+    for bundle_path, error in failed.items():
+        print(f" - {get_bundle_download_name(bundle_infos[bundle_path])}")
+        print(f"   {error}")
+    print()
+
+def get_offline_failures(infos):
+    return {info['path']: FileNotFoundError("Not downloaded yet, unavailable while offline") for info in infos}
+
+def parse_catalog(quality, version, required_assets, offline=False):
+    bundle_infos = resolve_catalog_bundles(version, required_assets)
+    bundle_names = {info['bundle_name'] for info in bundle_infos.values()}
+
+    missing_bundles = [info for info in bundle_infos.values() if not is_bundle_downloaded(info)]
+    failed = {}
+    if missing_bundles and offline:
+        failed = get_offline_failures(missing_bundles)
+    elif missing_bundles:
+        failed = download_bundles(quality, version, missing_bundles)
+        print("")
+
+    report_failed_downloads(failed, bundle_infos)
+
+    for bundle_path in bundle_infos:
+        if bundle_path not in failed:
+            skeleton_data_bundles_paths.append(bundle_path)
+
+    return list(bundle_names)
+
+def format_size(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} {unit}"
+        size /= 1024
+
+def get_catalog_bundles(version):
+    connection = sqlite3.connect(f"file:{get_catalog_index_path(version).as_posix()}?mode=ro", uri=True)
+    try:
+        return {name: (bundle_hash, size) for name, bundle_hash, size in connection.execute("SELECT name, hash, size FROM bundles")}
+    finally:
+        connection.close()
+
+def diff_catalogs(old_version, new_version):
+    old_bundles = get_catalog_bundles(old_version)
+    new_bundles = get_catalog_bundles(new_version)
+
+    unchanged = {name for name, (bundle_hash, _) in new_bundles.items() if name in old_bundles and old_bundles[name][0] == bundle_hash}
+    changed = {name for name in new_bundles if name in old_bundles and name not in unchanged}
+    removed = set(old_bundles) - set(new_bundles)
+    return unchanged, changed, removed
+
+def get_catalog_quality(version):
+    try:
+        connection = sqlite3.connect(f"file:{get_catalog_index_path(version).as_posix()}?mode=ro", uri=True)
+        try:
+            row = connection.execute("SELECT value FROM info WHERE key = 'quality'").fetchone()
+        finally:
+            connection.close()
+        if row:
+            return row[0]
+    except sqlite3.Error:
+        pass
+
+    # Indexes built before the quality was recorded are matched against the last known versions
+    cache = load_maintenance_info_cache()
+    if cache:
+        for quality in ("HD", "SD"):
+            if get_bundle_version(cache[1], quality) == version:
+                return quality
+    return None
+
+def clean_old_catalogs(quality, version):
+    new_bundles = get_catalog_bundles(version)
+    old_versions = {path.stem[len("catalog_"):] for path in base_path.glob("catalog_*") if path.suffix in (".json", ".db")}
+    old_versions.discard(version)
+
+    for old_version in sorted(old_versions):
+        old_quality = get_catalog_quality(old_version) if get_catalog_index_path(old_version).exists() else None
+        # The catalog of the other quality is still needed to repack it offline
+        if old_quality is not None and old_quality != quality:
             continue
 
-        asset_name = Path(key).name.lower()
-        if asset_name in required_assets and asset_name not in asset_hits:
-            asset_hits[asset_name] = (m, str(raw_key))
-
-    def resolve_bundle_info(entry_index):
-        if entry_index in bundles:
-            return bundles[entry_index]
-        if entry_index < 0 or entry_index >= len(entries):
-            return None
-        dep_idx = entries[entry_index]['dependency_index']
-        if dep_idx < 0 or dep_idx >= len(dependency_map):
-            return None
-        deps = dependency_map[dep_idx] or []
-        for dep_entry in deps:
-            info = bundles.get(dep_entry)
-            if info:
-                return info
-        return None
+        if old_quality == quality:
+            try:
+                unchanged, changed, removed = diff_catalogs(old_version, version)
+                print(f" Catalog {old_version} -> {version}: {len(unchanged)} bundles unchanged, {len(changed)} updated, {len(removed)} removed")
+            except sqlite3.Error:
+                pass
 
-    for asset_name in sorted(required_assets):
-        entry_info = asset_hits.get(asset_name)
-        if not entry_info:
+        for old_path in (base_path.joinpath(f"catalog_{old_version}.json"), get_catalog_index_path(old_version)):
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+    # Outdated bundles stay in the store until they are evicted, the other quality may still use them
+    cached = [size for bundle_hash, size in new_bundles.values() if asset_bundles_folder_path.joinpath(bundle_hash, '__data').is_file()]
+    if cached:
+        print(f" {len(cached)} bundles of this catalog are already cached ({format_size(sum(cached))} not downloaded again)")
+
+def touch_file(file_path):
+    # The modification time of a cached file is its last use
+    try:
+        os.utime(file_path)
+    except OSError:
+        pass
+
+def migrate_legacy_bundles():
+    # Bundles used to be stored as name/hash/__data, move them into the hash keyed store
+    if not asset_bundles_folder_path.exists():
+        return
+
+    for bundle_dir in list(asset_bundles_folder_path.iterdir()):
+        if not bundle_dir.is_dir() or bundle_dir.joinpath('__data').exists():
+            continue
+        hash_dirs = [path for path in bundle_dir.iterdir() if path.is_dir()]
+        if not hash_dirs:
             continue
 
-        entry_index, bundle_key = entry_info
-        info = resolve_bundle_info(entry_index)
-        if not info:
+        for hash_dir in hash_dirs:
+            store_dir = asset_bundles_folder_path.joinpath(hash_dir.name)
+            if store_dir.exists():
+                shutil.rmtree(hash_dir, ignore_errors=True)
+            else:
+                os.replace(hash_dir, store_dir)
+        if not any(bundle_dir.iterdir()):
+            bundle_dir.rmdir()
+
+def trim_bundle_store(protected_paths=()):
+    if bundle_cache_budget_gb is None or not asset_bundles_folder_path.exists():
+        return
+
+    entries = []
+    for store_dir in asset_bundles_folder_path.iterdir():
+        bundle_path = store_dir.joinpath('__data')
+        if bundle_path.is_file():
+            stat = bundle_path.stat()
+            entries.append((stat.st_mtime, stat.st_size, store_dir, str(bundle_path)))
+
+    budget = int(bundle_cache_budget_gb * 1024 ** 3)
+    total_size = sum(size for _, size, _, _ in entries)
+    removed_count = 0
+    removed_size = 0
+    removed_hashes = []
+    # Least recently used first, bundles of the current run are never evicted
+    for _, size, store_dir, bundle_path in sorted(entries, key=lambda entry: entry[0]):
+        if total_size <= budget:
+            break
+        if bundle_path in protected_paths:
             continue
+        shutil.rmtree(store_dir, ignore_errors=True)
+        total_size -= size
+        removed_count += 1
+        removed_size += size
+        removed_hashes.append(store_dir.name)
+
+    forget_container_index(removed_hashes)
+    if removed_count:
+        print(f" Removed {removed_count} least recently used bundles ({format_size(removed_size)}) to stay under {bundle_cache_budget_gb} GB")
+
+def read_bundle_content(container):
+    # Keep only the TextAsset and Texture2D entries of the container, as type name and path_id
+    return {
+        path: (obj.type.name, obj.path_id) for path, obj in container.items()
+        if obj.type.name in ["TextAsset", "Texture2D"] and hasattr(obj, 'path_id')
+    }
 
-        bundle_names.add(info['bundle_name'])
-        bundle_path = Path(info['path'])
+def get_bundle_hash(file_path):
+    return Path(file_path).parent.name
 
-        if not bundle_path.exists():
-            download_name = info['bundle_key'] or bundle_path.name
-            download_name = re.sub(r'_[a-f0-9]+(?=\.bundle)', '', download_name)
-            url = f"https://cdn.bd2.pmang.cloud/ServerData/Android/{quality}/{version}/{download_name}"
-            response = requests.get(url, stream=True)
+def open_container_index():
+    connection = sqlite3.connect(container_index_path)
+    connection.execute("CREATE TABLE IF NOT EXISTS bundles (hash TEXT PRIMARY KEY) WITHOUT ROWID")
+    connection.execute("CREATE TABLE IF NOT EXISTS containers (hash TEXT, path TEXT, type TEXT, path_id INTEGER, PRIMARY KEY (hash, path)) WITHOUT ROWID")
+    return connection
 
-            bundle_path.parent.mkdir(parents=True, exist_ok=True)
-            with open(bundle_path, 'wb') as file:
-                with tqdm(desc=f" Downloading {download_name}...", ascii=" ##########", bar_format="{desc} {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt}", colour="green", total=info['size']) as pbar:
-                    for chunk in response.iter_content(chunk_size=1024 * 64):
-                        if chunk:
-                            file.write(chunk)
-                            pbar.update(len(chunk))
-            print("")
+def load_container_index(file_paths):
+    # Container mappings of the bundles scanned on a previous run, a bundle never changes for a given hash
+    paths_by_hash = {get_bundle_hash(file_path): file_path for file_path in file_paths}
+    bundle_hashes = list(paths_by_hash)
+    contents = {}
+    try:
+        connection = open_container_index()
+    except sqlite3.Error:
+        return contents
 
-        if bundle_path not in resolved_paths:
-            skeleton_data_bundles_paths.append(str(bundle_path))
-            resolved_paths.add(bundle_path)
+    try:
+        # Query in chunks to stay below SQLite's host parameter limit
+        for start in range(0, len(bundle_hashes), 500):
+            chunk = bundle_hashes[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for (bundle_hash,) in connection.execute(f"SELECT hash FROM bundles WHERE hash IN ({placeholders})", chunk):
+                contents[paths_by_hash[bundle_hash]] = {}
+            rows = connection.execute(f"SELECT hash, path, type, path_id FROM containers WHERE hash IN ({placeholders})", chunk)
+            for bundle_hash, path, type_name, path_id in rows:
+                contents[paths_by_hash[bundle_hash]][path] = (type_name, path_id)
+    except sqlite3.Error:
+        contents = {}
+    finally:
+        connection.close()
+
+    return contents
+
+def save_container_index(bundle_contents):
+    if not bundle_contents:
+        return
 
-    return list(bundle_names)
+    try:
+        connection = open_container_index()
+    except sqlite3.Error:
+        return
 
-def clean_old_bundles(old_bundle_names, new_bundle_names):
-    print(" Cleaning old bundles...")
-    for old_name in old_bundle_names:
-        if not old_name in new_bundle_names:
-            shutil.rmtree(asset_bundles_folder_path.joinpath(old_name))
+    try:
+        with connection:
+            for file_path, bundle_content in bundle_contents.items():
+                bundle_hash = get_bundle_hash(file_path)
+                connection.execute("DELETE FROM containers WHERE hash = ?", (bundle_hash,))
+                connection.executemany(
+                    "INSERT INTO containers (hash, path, type, path_id) VALUES (?, ?, ?, ?)",
+                    [(bundle_hash, path, type_name, path_id) for path, (type_name, path_id) in bundle_content.items()]
+                )
+                connection.execute("INSERT OR REPLACE INTO bundles (hash) VALUES (?)", (bundle_hash,))
+    except sqlite3.Error:
+        pass
+    finally:
+        connection.close()
+
+def forget_container_index(bundle_hashes):
+    if not bundle_hashes or not container_index_path.exists():
+        return
+
+    try:
+        connection = open_container_index()
+    except sqlite3.Error:
+        return
+
+    try:
+        with connection:
+            connection.executemany("DELETE FROM bundles WHERE hash = ?", [(bundle_hash,) for bundle_hash in bundle_hashes])
+            connection.executemany("DELETE FROM containers WHERE hash = ?", [(bundle_hash,) for bundle_hash in bundle_hashes])
+    except sqlite3.Error:
+        pass
+    finally:
+        connection.close()
+
+class EnvironmentCache:
+    # Bounded LRU of loaded bundles, so a bundle parsed for matching is not loaded again to be repacked
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.environments = OrderedDict()
+
+    def __contains__(self, file_path):
+        return file_path in self.environments
+
+    def put(self, file_path, env):
+        if self.max_size <= 0:
+            return
+        self.environments[file_path] = env
+        self.environments.move_to_end(file_path)
+        while len(self.environments) > self.max_size:
+            self.environments.popitem(last=False)
+
+    def take(self, file_path):
+        # Repacking modifies the environment, so it leaves the cache, evicted ones are loaded again
+        env = self.environments.pop(file_path, None)
+        return env if env is not None else load_bundle(file_path)
+
+    def clear(self):
+        self.environments.clear()
+
+loaded_environments = EnvironmentCache(environment_cache_size)
+
+def load_bundle(file_path):
+    if memory_mapped_bundles:
+        try:
+            return unityfs.load_bundle(file_path)
+        except Exception:
+            pass  # Encrypted or non UnityFS bundles, or anything the mapped loader can't handle, go through UnityPy
+    return UnityPy.load(file_path)
+
+def scan_bundle(file_path):
+    # Runs in the worker processes, only the container mapping is sent back
+    if header_only_scan:
+        try:
+            return read_bundle_content(unityfs.read_bundle_container(file_path))
+        except Exception:
+            pass  # Bundles the scanner can't read go through a full load
+    return read_bundle_content(load_bundle(file_path).container)
+
+def create_process_pool(workers):
+    # Forked workers would inherit the pipes of astcenc calls running in other threads and keep
+    # them open forever, forkserver starts them from a process that never runs any threads
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver"))
+    return ProcessPoolExecutor(max_workers=workers)
 
 def parse_asset_bundles():
     asset_bundles = {}
     
-    file_count = len(skeleton_data_bundles_paths)
+    file_paths = list(skeleton_data_bundles_paths)
+    file_count = len(file_paths)
     with tqdm(desc=" Parsing bundles...", ascii=" ##########", bar_format="{desc} {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt}", colour="green", total=file_count) as pbar:
-        for file_path in skeleton_data_bundles_paths:
-            pbar.update(1)
-            # Load asset bundle and filter for TextAsset or Texture2D
-            env = UnityPy.load(file_path)
-            bundle_content = {
-                path: obj for path, obj in env.container.items()
-                if obj.type.name in ["TextAsset", "Texture2D"] and hasattr(obj, 'path_id')
-            }
-            # Only add the bundle to the dictionary if it has valid assets
-            if bundle_content:
-                asset_bundles[file_path] = bundle_content
+        # Bundles already in the container index are not loaded at all
+        bundle_contents = load_container_index(file_paths)
+        pbar.update(len(bundle_contents))
+
+        new_paths = [file_path for file_path in file_paths if file_path not in bundle_contents]
+        new_contents = {}
+        workers = min(parse_workers or os.cpu_count() or 1, len(new_paths))
+        if workers > 1:
+            with create_process_pool(workers) as executor:
+                for file_path, bundle_content in zip(new_paths, executor.map(scan_bundle, new_paths)):
+                    pbar.update(1)
+                    new_contents[file_path] = bundle_content
+        elif header_only_scan:
+            for file_path in new_paths:
+                pbar.update(1)
+                new_contents[file_path] = scan_bundle(file_path)
+        else:
+            for file_path in new_paths:
+                pbar.update(1)
+                env = load_bundle(file_path)
+                new_contents[file_path] = read_bundle_content(env.container)
+                # With a memory budget nothing stays loaded between the steps
+                if new_contents[file_path] and not repack_memory_budget_mb:
+                    loaded_environments.put(file_path, env)
+
+        save_container_index(new_contents)
+        bundle_contents.update(new_contents)
+
+    for file_path in file_paths:
+        # Only add the bundle to the dictionary if it has valid assets
+        if bundle_contents[file_path]:
+            asset_bundles[file_path] = bundle_contents[file_path]
                 
     return asset_bundles
 
@@ -365,117 +979,815 @@ def parse_mods():
 
     return mods_files, duplicate_files, json_to_skel_files
 
-def associate_mods_with_bundles(asset_bundles, mods_files):
-    matched_mods = {}
-    with tqdm(desc=" Preparing files associations...", ascii=" ##########", bar_format="{desc} {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt}", colour="green", total=len(mods_files)) as pbar:
-        for bundle_path, bundle_content in asset_bundles.items():
-            for mod_filename, mod_filepath in mods_files.items():
-                if mod_filename in bundle_content:
-                    pbar.update(1)
-                    if bundle_path not in matched_mods:
-                        matched_mods[bundle_path] = []
-                    matched_mods[bundle_path].append((mod_filename, mod_filepath))
-                
-        matched_files = {mod_filename for mods in matched_mods.values() for mod_filename, _ in mods}
-        unmatched_mods = {mod_filename: mod_filepath for mod_filename, mod_filepath in mods_files.items() if mod_filename not in matched_files}
-        pbar.update(len(unmatched_mods))
+def match_bundle_mods(bundle_content, mods_files):
+    return [(mod_filename, mod_filepath) for mod_filename, mod_filepath in mods_files.items() if mod_filename in bundle_content]
 
+def report_unmatched_mods(unmatched_mods):
     if unmatched_mods:
         print()
         print(" \033[33mCould not find matching asset bundles for the following files:\033[0m")
         for mod_filename, mod_filepath in unmatched_mods.items():
             print(f" - {mod_filepath}")
         print()
+
+def get_unmatched_mods(matched_mods, mods_files):
+    matched_files = {mod_filename for mods in matched_mods.values() for mod_filename, _ in mods}
+    return {mod_filename: mod_filepath for mod_filename, mod_filepath in mods_files.items() if mod_filename not in matched_files}
+
+def build_container_index(asset_bundles):
+    # Container path -> bundles holding it, in bundle order
+    container_index = {}
+    for bundle_path, bundle_content in asset_bundles.items():
+        for path in bundle_content:
+            container_index.setdefault(path, []).append(bundle_path)
+    return container_index
+
+def associate_mods_with_bundles(asset_bundles, mods_files):
+    container_index = build_container_index(asset_bundles)
+    bundle_mods = {}
+    with tqdm(desc=" Preparing files associations...", ascii=" ##########", bar_format="{desc} {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt}", colour="green", total=len(mods_files)) as pbar:
+        for mod_filename, mod_filepath in mods_files.items():
+            for bundle_path in container_index.get(mod_filename, ()):
+                bundle_mods.setdefault(bundle_path, []).append((mod_filename, mod_filepath))
+                pbar.update(1)
+
+        # Keep the bundles in parsing order
+        matched_mods = {bundle_path: bundle_mods[bundle_path] for bundle_path in asset_bundles if bundle_path in bundle_mods}
+                
+        unmatched_mods = get_unmatched_mods(matched_mods, mods_files)
+        pbar.update(len(unmatched_mods))
+
+    report_unmatched_mods(unmatched_mods)
         
     return matched_mods
 
-def clear_modded_folder():
-    """Delete all files in the modded folder."""
-    if asset_bundles_modded_folder_path.exists():
-        shutil.rmtree(asset_bundles_modded_folder_path)  # Delete the folder and all its contents
-    asset_bundles_modded_folder_path.mkdir(parents=True)  # Recreate the folder
+class BuildManifest:
+    # Inputs each bundle in the modded folder was built from, a bundle is only rebuilt when they change
+    def __init__(self, quality):
+        self.quality = quality
+        self.entries = self.load()
+        self.outputs = set()  # Bundles of the current run, everything else in the modded folder is stale
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(build_manifest_path, "r") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get('version') != build_manifest_version:
+            return {}
+        return manifest.get('bundles', {})
+
+    def save(self):
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=build_manifest_path.parent)
+        with os.fdopen(fd, "w") as f:
+            json.dump({'version': build_manifest_version, 'bundles': self.entries}, f, indent=2)
+        os.replace(tmp_path, build_manifest_path)
+
+    def get_key(self, bundle_path):
+        return get_modded_bundle_path(bundle_path).relative_to(asset_bundles_modded_folder_path).as_posix()
+
+    def get_inputs(self, bundle_path, mods):
+        inputs = {
+            'source': get_bundle_hash(bundle_path),
+            'quality': self.quality,
+            'packer': bundle_packer,
+            'mods': {mod_filename: get_file_hash(mod_filepath) for mod_filename, mod_filepath in mods},
+        }
+        # Only textures depend on the encoder
+        if any(mod_filename.endswith(".png") for mod_filename, _ in mods):
+            backend = get_texture_encoder_backend()
+            inputs['encoder'] = [backend.name, *backend.get_cache_key()]
+        return inputs
+
+    def is_current(self, bundle_path, mods):
+        key = self.get_key(bundle_path)
+        inputs = self.get_inputs(bundle_path, mods)
+        with self.lock:
+            self.outputs.add(key)
+            return self.entries.get(key) == inputs and asset_bundles_modded_folder_path.joinpath(key).exists()
+
+    def record(self, bundle_path, mods):
+        key = self.get_key(bundle_path)
+        inputs = self.get_inputs(bundle_path, mods)
+        with self.lock:
+            self.entries[key] = inputs
+
+    def forget(self, bundle_path):
+        # A bundle repacked with errors is rebuilt on the next run
+        with self.lock:
+            self.entries.pop(self.get_key(bundle_path), None)
+
+    def record_result(self, bundle_path, mods, bundle_errors):
+        if bundle_errors:
+            self.forget(bundle_path)
+        else:
+            self.record(bundle_path, mods)
+
+    def remove_stale(self):
+        with self.lock:
+            self.entries = {key: inputs for key, inputs in self.entries.items() if key in self.outputs}
+            if not asset_bundles_modded_folder_path.exists():
+                return
+            for root, folders, files in os.walk(asset_bundles_modded_folder_path, topdown=False):
+                root = Path(root)
+                for file in files:
+                    file_path = root.joinpath(file)
+                    if file_path.relative_to(asset_bundles_modded_folder_path).as_posix() not in self.outputs:
+                        os.remove(file_path)
+                if root != asset_bundles_modded_folder_path and not any(root.iterdir()):
+                    root.rmdir()
+
+def get_astc_encode_layout():
+    # Split the CPU cores between parallel astcenc processes and the threads of each one
+    cores = os.cpu_count() or 1
+    jobs = astc_encode_jobs or max(1, cores // (astc_encode_threads or 2))
+    threads = astc_encode_threads or max(1, cores // jobs)
+    return jobs, threads
+
+def create_texture_encoder():
+    # Both backends encode outside the GIL, so threads are enough to keep several encodes going
+    jobs, _ = get_astc_encode_layout()
+    return ThreadPoolExecutor(max_workers=jobs)
+
+def submit_texture_encodes(encoder, texture_futures, mods, bundle_content, quality):
+    # Each texture is encoded once, even when several bundles use it.
+    # The write stage may drop entries meanwhile, so each one is looked up once and kept
+    encoded_textures = {}
+    for mod_filename, mod_filepath in mods:
+        if bundle_content[mod_filename][0] == "Texture2D":
+            future = texture_futures.get(mod_filepath)
+            if future is None:
+                future = encoder.submit(encode_texture, mod_filepath, quality)
+                texture_futures[mod_filepath] = future
+            encoded_textures[mod_filepath] = future
+    return encoded_textures
+
+def get_encoded_textures(encoded_textures):
+    # Failed encodes are passed on as their exception, repack_bundle reports them like any other error
+    return {mod_filepath: future.exception() or future.result() for mod_filepath, future in encoded_textures.items()}
+
+def get_astc_encode_tmp_folder():
+    # The encoded file is written and read back once, RAM-backed storage avoids the disk round trip
+    ram_folder = Path("/dev/shm")
+    if astc_encode_ram_tmp and ram_folder.is_dir() and os.access(ram_folder, os.W_OK):
+        return ram_folder
+
+    if not astc_encode_tmp_folder_path.exists():
+        astc_encode_tmp_folder_path.mkdir(parents=True, exist_ok=True)
+    return astc_encode_tmp_folder_path
 
 def astc_encode_image(file_path, block):
     file_path = Path(file_path)
-    output_path = astc_encode_tmp_folder_path.joinpath(file_path.name.replace(file_path.suffix, ".astc"))
 
-    if not astc_encode_tmp_folder_path.exists():
-        astc_encode_tmp_folder_path.mkdir(parents=True, exist_ok=True)
+    # Unique output per job, mods in different folders can share a file name and encode at the same time
+    fd, output_path = tempfile.mkstemp(prefix="redustx_" + file_path.stem + "_", suffix=".astc", dir=get_astc_encode_tmp_folder())
+    os.close(fd)
 
-    args = [str(astc_encoder_binary_path), "-cs", str(file_path), str(output_path), block, "-medium", "-yflip", "-decode_unorm8", "-silent"]
+    _, threads = get_astc_encode_layout()
+    args = [str(astc_encoder_binary_path), "-cs", str(file_path), str(output_path), block, *astc_encode_flags, "-silent", "-j", str(threads)]
     try:
         subprocess.check_call(args)
 
         with open(output_path, "rb") as f:
-            data = f.read()[16:]
+            # Read the payload straight into its buffer, past the 16 byte .astc header
+            data = bytearray(os.fstat(f.fileno()).st_size - 16)
+            f.seek(16)
+            if f.readinto(data) != len(data):
+                raise IOError(f"Incomplete astcenc output {output_path}")
 
         os.remove(output_path)
         return data
     except Exception as e:
+        if os.path.exists(output_path):
+            os.remove(output_path)
         print()
         print(" \033[31mAn error occured compressing the textures, make sure the path to the png files doesn't contain non-ASCII characters such as Chinese characters\033[0m")
         print()
         raise(e)
 
+astc_quality_presets = {
+    "-fastest": astc_encoder.ASTCQualityPreset.FASTEST,
+    "-fast": astc_encoder.ASTCQualityPreset.FAST,
+    "-medium": astc_encoder.ASTCQualityPreset.MEDIUM,
+    "-thorough": astc_encoder.ASTCQualityPreset.THOROUGH,
+    "-verythorough": astc_encoder.ASTCQualityPreset.VERYTHOROUGH,
+    "-exhaustive": astc_encoder.ASTCQualityPreset.EXHAUSTIVE,
+}
+
+def get_astc_encoder_config(block):
+    # Translate astc_encode_flags, so both backends produce the same kind of texture
+    block_x, block_y = (int(size) for size in block.split("x"))
+    quality = astc_encoder.ASTCQualityPreset.MEDIUM
+    flags = 0
+    flip = False
+    for flag in astc_encode_flags:
+        if flag in astc_quality_presets:
+            quality = astc_quality_presets[flag]
+        elif flag == "-decode_unorm8":
+            flags |= astc_encoder.ASTCConfigFlags.USE_DECODE_UNORM8
+        elif flag == "-yflip":
+            flip = True
+        else:
+            raise ValueError(f"The astc_encoder backend doesn't support the astcenc option {flag}")
+    return astc_encoder.ASTCConfig(astc_encoder.ASTCProfile.LDR_SRGB, block_x, block_y, 1, quality, flags), flip
+
+class AstcencBackend:
+    # Runs the astcenc program on the png file, one process per texture
+    name = "astcenc"
+
+    def get_cache_key(self):
+        return [" ".join(astc_encode_flags), get_encoder_binary_hash()]
+
+    def encode(self, mod_filepath, image, block):
+        return astc_encode_image(mod_filepath, block)
+
+class AstcEncoderBackend:
+    # Decodes the image and encodes it in-process, without spawning astcenc or writing temp files
+    name = "astc_encoder"
+
+    def __init__(self):
+        self.local = threading.local()  # An encoder context can't be shared between threads
+
+    def get_cache_key(self):
+        return [self.name, astc_encoder.__version__, " ".join(astc_encode_flags)]
+
+    def get_context(self, block):
+        if not hasattr(self.local, "contexts"):
+            self.local.contexts = {}
+        contexts = self.local.contexts
+        if block not in contexts:
+            config, flip = get_astc_encoder_config(block)
+            _, threads = get_astc_encode_layout()
+            contexts[block] = astc_encoder.ASTCContext(config, threads), flip
+        return contexts[block]
+
+    def encode(self, mod_filepath, image, block):
+        context, flip = self.get_context(block)
+        image = image.convert('RGBA')
+        if flip:
+            image = image.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+        astc_image = astc_encoder.ASTCImage(astc_encoder.ASTCType.U8, image.width, image.height, 1, image.tobytes())
+        return context.compress(astc_image, astc_encoder.ASTCSwizzle.from_str("RGBA"))
+
+texture_encoder_backends = {
+    AstcencBackend.name: AstcencBackend,
+    AstcEncoderBackend.name: AstcEncoderBackend,
+}
+texture_encoders = {}
+
+def get_texture_encoder_backend(name=None):
+    name = name or texture_encoder_backend
+    if name not in texture_encoder_backends:
+        raise ValueError(f"Unknown texture encoder backend {name}, use one of: {', '.join(texture_encoder_backends)}")
+    if name not in texture_encoders:
+        texture_encoders[name] = texture_encoder_backends[name]()
+    return texture_encoders[name]
+
+encoder_binary_hashes = {}
+file_hashes = {}
+
+def hash_file(file_path):
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(0x100000), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def get_file_hash(file_path):
+    # Mod files are hashed by the build manifest and the texture cache, only once while they are unchanged
+    stat = os.stat(file_path)
+    key = (str(file_path), stat.st_size, stat.st_mtime_ns)
+    if key not in file_hashes:
+        file_hashes[key] = hash_file(file_path)
+    return file_hashes[key]
+
+def get_encoder_binary_hash():
+    # Hashed once per binary version, a different astcenc build may encode differently
+    try:
+        stat = astc_encoder_binary_path.stat()
+    except OSError:
+        return "missing"
+    key = (str(astc_encoder_binary_path), stat.st_size, stat.st_mtime)
+    if key not in encoder_binary_hashes:
+        encoder_binary_hashes[key] = hash_file(astc_encoder_binary_path)
+    return encoder_binary_hashes[key]
+
+def get_texture_cache_path(mod_filepath, block, backend):
+    key = "\n".join([get_file_hash(mod_filepath), block, *backend.get_cache_key()])
+    return texture_cache_folder_path.joinpath(hashlib.sha256(key.encode()).hexdigest() + ".astc")
+
+def read_texture_cache(cache_path):
+    try:
+        with open(cache_path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    touch_file(cache_path)
+    return data
+
+def write_texture_cache(cache_path, data):
+    texture_cache_folder_path.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=texture_cache_folder_path)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, cache_path)
+
+def trim_texture_cache():
+    if not texture_cache_folder_path.exists():
+        return
+
+    entries = []
+    for cache_path in texture_cache_folder_path.glob("*.astc"):
+        stat = cache_path.stat()
+        entries.append((stat.st_mtime, stat.st_size, cache_path))
+
+    budget = texture_cache_size_mb * 1024 ** 2
+    total_size = sum(size for _, size, _ in entries)
+    # Least recently used first
+    for _, size, cache_path in sorted(entries, key=lambda entry: entry[0]):
+        if total_size <= budget:
+            break
+        try:
+            os.remove(cache_path)
+        except OSError:
+            continue
+        total_size -= size
+
+def encode_texture(mod_filepath, quality):
+    try:
+        # Only the header is read here, the pixels are decoded by the backends that need them
+        new_texture = Image.open(mod_filepath)
+    except IOError:
+        return None  # Reported by the repack step
+
+    with new_texture:
+        block = "4x4" if quality == "HD" else "8x8"
+        backend = get_texture_encoder_backend()
+        if not texture_cache_size_mb:
+            return new_texture.width, new_texture.height, backend.encode(mod_filepath, new_texture, block)
+
+        # Unchanged images are not encoded again
+        cache_path = get_texture_cache_path(mod_filepath, block, backend)
+        astc_data = read_texture_cache(cache_path)
+        if astc_data is None:
+            astc_data = backend.encode(mod_filepath, new_texture, block)
+            write_texture_cache(cache_path, astc_data)
+        return new_texture.width, new_texture.height, astc_data
+
+def index_container(container):
+    # Container path -> objects, a path can point to several objects (e.g. a Texture2D and its Sprite)
+    objects = {}
+    for path, obj in container.items():
+        objects.setdefault(path, []).append(obj)
+    return objects
+
 # Function to replace files in the asset bundle with the corresponding mod files
-def replace_files_in_bundles(matched_mods, quality):
-    clear_modded_folder()
+def repack_bundle(env, mods, quality, errors, pbar=None, encoded_textures=None):
+    encoded_textures = encoded_textures or {}
+    container_objects = index_container(env.container)
+    replaced_count = 0
+    for mod_filename, mod_filepath in mods:
+        for obj in container_objects.get(mod_filename, ()):
+            try:
+                data = obj.read()
+                # Replace content with the mod file
+                if obj.type.name == "Texture2D":
+                    if mod_filepath in encoded_textures:
+                        texture = encoded_textures[mod_filepath]
+                        if isinstance(texture, Exception):
+                            raise texture
+                    else:
+                        texture = encode_texture(mod_filepath, quality)
+
+                    if texture is None:
+                        errors.append(f" Failed to open image file {mod_filepath}")
+                        continue  # Skip if there's an issue with the image
+
+                    width, height, astc_data = texture
+                    data.m_Width = width
+                    data.m_Height = height
+                    data.m_TextureFormat = UnityPy.enums.TextureFormat.ASTC_RGB_4x4 if quality == "HD" else UnityPy.enums.TextureFormat.ASTC_RGB_8x8
+                    data.image_data = astc_data
+                    data.m_CompleteImageSize = len(astc_data)
+                    data.m_MipCount = 1
+                    data.m_StreamData.offset = 0
+                    data.m_StreamData.size = 0
+                    data.m_StreamData.path = ""
+                elif obj.type.name == "TextAsset":
+                    with open(mod_filepath, "rb") as f:
+                        data.m_Script = f.read().decode(errors="surrogateescape")
+                else:
+                    continue
+                data.save()
+                replaced_count += 1
+                if pbar:
+                    pbar.update(1)
+            except Exception as e:
+                # A bad mod file only fails its own bundle, the other bundles are still repacked
+                errors.append(f" An error occured with {mod_filepath}: {e}")
+
+    return replaced_count
+
+def repack_bundle_file(bundle_path, mods, quality, modded_bundle_path=None, encoded_textures=None, compress_threads=None):
+    # Runs in the worker processes or for the bundles repacked in this one,
+    # errors are sent back instead of stopping the other bundles
+    errors = []
+    replaced_count = 0
+    try:
+        env = loaded_environments.take(bundle_path)
+        replaced_count = repack_bundle(env, mods, quality, errors, encoded_textures=encoded_textures)
+        write_modded_bundle(bundle_path, env, modded_bundle_path, compress_threads)
+    except Exception as e:
+        errors.append(f" Failed to repack {bundle_path}: {e}")
+        remove_modded_bundle(bundle_path, modded_bundle_path)
+    env = None
+    release_memory()
+    return replaced_count, errors
+
+def get_modded_bundle_path(bundle_path):
+    bundle_path = Path(bundle_path)
+    bundle_name = bundle_store_names.get(str(bundle_path))
+    if bundle_name:
+        # The game cache expects name/hash/__data
+        return asset_bundles_modded_folder_path.joinpath(bundle_name, bundle_path.parent.name, bundle_path.name)
+
+    # Get the relative path from the original bundles folder
+    relative_path = bundle_path.relative_to(asset_bundles_folder_path)
+    return asset_bundles_modded_folder_path.joinpath(relative_path)
+
+def get_bundle_compress_threads(workers=1):
+    # Each repack worker compresses its own bundle, together they shouldn't start more threads than there are cores
+    return bundle_compress_threads or max(1, (os.cpu_count() or 1) // workers)
+
+def write_modded_bundle(bundle_path, env, modded_bundle_path=None, compress_threads=None):
+    # Create the full path in the modded folder
+    modded_bundle_path = Path(modded_bundle_path or get_modded_bundle_path(bundle_path))
+    # Ensure the directories exist
+    modded_folder = modded_bundle_path.parent
+    modded_folder.mkdir(parents=True, exist_ok=True)
+    
+    # Compressed block by block straight into the file, an interrupted write never replaces the previous bundle
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=modded_folder)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            unityfs.write_bundle(env.file, f, bundle_packer, bundle_path if preserve_original_blocks else None, compress_threads or get_bundle_compress_threads())
+        os.replace(tmp_path, modded_bundle_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def remove_modded_bundle(bundle_path, modded_bundle_path=None):
+    # A bundle that couldn't be rebuilt loses its previous output, built from older mods
+    try:
+        os.remove(modded_bundle_path or get_modded_bundle_path(bundle_path))
+    except OSError:
+        pass
+
+def estimate_repack_memory(bundle_path):
+    # Decompressed data, the objects parsed from it and the nodes serialized again while writing
+    try:
+        with open(bundle_path, "rb") as f:
+            size = unityfs.UnityFSFile(f).length
+    except (ValueError, NotImplementedError):
+        size = os.path.getsize(bundle_path)
+    return size * 3
+
+def plan_repack_groups(bundle_paths):
+    if not repack_memory_budget_mb:
+        return [bundle_paths]
+
+    # Consecutive bundles that fit the budget together, a bigger bundle goes alone
+    budget = repack_memory_budget_mb * 1024 ** 2
+    groups = []
+    group = []
+    group_size = 0
+    for bundle_path in bundle_paths:
+        size = estimate_repack_memory(bundle_path)
+        if group and group_size + size > budget:
+            groups.append(group)
+            group = []
+            group_size = 0
+        group.append(bundle_path)
+        group_size += size
+    if group:
+        groups.append(group)
+    return groups
+
+def release_memory():
+    # Environments reference themselves through their objects, only the cycle collector frees them
+    if repack_memory_budget_mb:
+        gc.collect()
+
+class MemoryBudget:
+    # Bytes reserved by the bundles between loading and writing, a bundle bigger than the budget
+    # still gets through once nothing else is reserved
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.cancelled = False
+        self.condition = threading.Condition()
+
+    def acquire(self, amount):
+        with self.condition:
+            self.condition.wait_for(lambda: self.cancelled or self.used == 0 or self.used + amount <= self.size)
+            self.used += amount
+
+    def release(self, amount):
+        with self.condition:
+            self.used -= amount
+            self.condition.notify_all()
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+def repack_bundle_group(group_mods, quality, asset_bundles, encoder, manifest, errors, pbar):
+    # Bundles still loaded from the parsing step are repacked here, before anything else can evict them
+    loaded_paths = [bundle_path for bundle_path in group_mods if bundle_path in loaded_environments]
+    other_paths = [bundle_path for bundle_path in group_mods if bundle_path not in loaded_environments]
+    workers = min(repack_workers or os.cpu_count() or 1, len(other_paths))
+    texture_futures = {}  # Encoded textures are released with the group
+
+    def get_bundle_textures(bundle_path):
+        if asset_bundles is None:
+            return {}  # Without the container types, repack_bundle encodes textures itself
+        return get_encoded_textures(submit_texture_encodes(encoder, texture_futures, group_mods[bundle_path], asset_bundles[bundle_path], quality))
+
+    def add_result(bundle_path, replaced_count, bundle_errors):
+        pbar.update(replaced_count)
+        errors.extend(bundle_errors)
+        manifest.record_result(bundle_path, group_mods[bundle_path], bundle_errors)
+
+    # Start every texture encode up front, bundles then only wait for their own textures
+    if asset_bundles is not None:
+        for bundle_path, mods in group_mods.items():
+            submit_texture_encodes(encoder, texture_futures, mods, asset_bundles[bundle_path], quality)
+
+    if workers > 1:
+        compress_threads = get_bundle_compress_threads(workers)
+        with create_process_pool(workers) as executor:
+            futures = {}
+            for bundle_path in other_paths:
+                modded_bundle_path = str(get_modded_bundle_path(bundle_path))
+                future = executor.submit(repack_bundle_file, bundle_path, group_mods[bundle_path], quality, modded_bundle_path, get_bundle_textures(bundle_path), compress_threads)
+                futures[future] = bundle_path
+
+            for bundle_path in loaded_paths:
+                add_result(bundle_path, *repack_bundle_file(bundle_path, group_mods[bundle_path], quality, None, get_bundle_textures(bundle_path), compress_threads))
+
+            for future in as_completed(futures):
+                bundle_path = futures[future]
+                try:
+                    replaced_count, bundle_errors = future.result()
+                except Exception as e:
+                    # Only a crashed worker gets here, repack_bundle_file reports its own errors
+                    replaced_count, bundle_errors = 0, [f" Failed to repack {bundle_path}: {e}"]
+                    remove_modded_bundle(bundle_path)
+                add_result(bundle_path, replaced_count, bundle_errors)
+    else:
+        for bundle_path in loaded_paths + other_paths:
+            add_result(bundle_path, *repack_bundle_file(bundle_path, group_mods[bundle_path], quality, None, get_bundle_textures(bundle_path)))
+
+def replace_files_in_bundles(matched_mods, quality, asset_bundles=None):
+    manifest = BuildManifest(quality)
     
     errors = []
     file_count = sum(len(mods) for _, mods in matched_mods.items())
-    with tqdm(desc=" Repacking assets...", ascii=" ##########", bar_format="{desc} {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt}", colour="green", total=file_count) as pbar:
-        for bundle_path, mods in matched_mods.items():
-            env = UnityPy.load(bundle_path)
-            for mod_filename, mod_filepath in mods:
-                for path, obj in env.container.items():
-                    if path == mod_filename:
-                        try:
-                            data = obj.read()
-                            # Replace content with the mod file
-                            if obj.type.name == "Texture2D":
-                                try:
-                                    new_texture = Image.open(mod_filepath).convert('RGBA')  # Open image only once
-                                except IOError as e:
-                                    errors.append(f" Failed to open image file {mod_filepath}")
-                                    continue  # Skip if there's an issue with the image
-
-                                astc_data = astc_encode_image(mod_filepath, "4x4" if quality == "HD" else "8x8")
-                                data.m_Width = new_texture.width
-                                data.m_Height = new_texture.height
-                                data.m_TextureFormat = UnityPy.enums.TextureFormat.ASTC_RGB_4x4 if quality == "HD" else UnityPy.enums.TextureFormat.ASTC_RGB_8x8
-                                data.image_data = astc_data
-                                data.m_CompleteImageSize = len(astc_data)
-                                data.m_MipCount = 1
-                                data.m_StreamData.offset = 0
-                                data.m_StreamData.size = 0
-                                data.m_StreamData.path = ""
-                            elif obj.type.name == "TextAsset":
-                                with open(mod_filepath, "rb") as f:
-                                    data.m_Script = f.read().decode(errors="surrogateescape")
-                            else:
-                                continue
-                            pbar.update(1)
-                            data.save()
-                        except Exception as e:
-                            pbar.close()
-                            print()
-                            print(f" \033[31mAn error occured with {mod_filepath}\033[0m")
-                            print()
-                            raise(e)
-                    
-            # Get the relative path from the original bundles folder
-            relative_path = Path(bundle_path).relative_to(asset_bundles_folder_path)
-            # Create the full path in the modded folder
-            modded_bundle_path = asset_bundles_modded_folder_path.joinpath(relative_path)
-            # Ensure the directories exist
-            modded_folder = modded_bundle_path.parent
-            modded_folder.mkdir(parents=True, exist_ok=True)
-            
-            with open(modded_bundle_path, "wb") as f:
-                f.write(env.file.save(packer="lz4"))
-            
+    # Bundles built from the same inputs on a previous run are kept as they are
+    pending_mods = {bundle_path: mods for bundle_path, mods in matched_mods.items() if not manifest.is_current(bundle_path, mods)}
+    up_to_date_count = file_count - sum(len(mods) for _, mods in pending_mods.items())
+    encoder = create_texture_encoder()
+
+    try:
+        with tqdm(desc=" Repacking assets...", ascii=" ##########", bar_format="{desc} {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt}", colour="green", total=file_count, initial=up_to_date_count) as pbar:
+            # With a memory budget, each group of bundles is written and released before the next one is loaded
+            for group in plan_repack_groups(list(pending_mods)):
+                group_mods = {bundle_path: pending_mods[bundle_path] for bundle_path in group}
+                repack_bundle_group(group_mods, quality, asset_bundles, encoder, manifest, errors, pbar)
+                release_memory()
+
+        manifest.remove_stale()
+    finally:
+        encoder.shutdown(wait=True, cancel_futures=True)
+        loaded_environments.clear()
+        manifest.save()
+
     return errors
 
+def run_staged_repack(quality, version, mods_files, offline=False):
+    parse_catalog(quality, version, mods_files.keys(), offline)
+    asset_bundles = parse_asset_bundles()
+    matched_mods = associate_mods_with_bundles(asset_bundles, mods_files)
+
+    if not matched_mods:
+        loaded_environments.clear()
+        return matched_mods, []
+    return matched_mods, replace_files_in_bundles(matched_mods, quality, asset_bundles)
+
+def run_repack_pipeline(quality, version, mods_files, offline=False):
+    # Download -> scan -> parse & match -> replace -> compress & write, each stage in its own thread.
+    # Bundles move to the next stage as soon as they are ready, bounded queues cap how many
+    # parsed environments are alive at once.
+    bundle_infos = resolve_catalog_bundles(version, mods_files.keys())
+
+    scan_queue = queue.Queue()  # Only paths, downloads never have to wait for the parser
+    scan_workers = parse_workers or os.cpu_count() or 1
+    # Scans running in the parse pool, matched in download order by the parse stage
+    parse_queue = queue.Queue(maxsize=max(pipeline_queue_size, scan_workers * 2))
+    workers = repack_workers or os.cpu_count() or 1
+    repack_queue = queue.Queue(maxsize=pipeline_queue_size)
+    # With a process pool the write stage holds the running jobs, enough to keep every worker busy
+    write_queue = queue.Queue(maxsize=max(pipeline_queue_size, workers))
+
+    matched_mods = {}
+    errors = []
+    failures = []
+    failed_downloads = {}
+    manifest = BuildManifest(quality)
+    known_contents = load_container_index(bundle_infos)
+    new_contents = {}
+    encoder = create_texture_encoder()
+    texture_futures = {}
+    parse_pool = create_process_pool(scan_workers) if scan_workers > 1 else None
+    repack_pool = create_process_pool(workers) if workers > 1 else None
+    budget = MemoryBudget(repack_memory_budget_mb * 1024 ** 2) if repack_memory_budget_mb else None
+    reserved_memory = {}
+    written_paths = []
+
+    def run_stage(input_queue, output_queue, process, on_done=None):
+        while True:
+            item = input_queue.get()
+            if item is None:
+                break
+            # After a failure the stage only drains its queue so nothing upstream blocks
+            if failures:
+                continue
+            try:
+                process(item)
+            except Exception as e:
+                failures.append(e)
+                if budget is not None:
+                    budget.cancel()
+            item = None  # The last environment isn't kept alive while waiting
+            if on_done is not None:
+                on_done()
+        if output_queue is not None:
+            output_queue.put(None)
+
+    def download_stage():
+        try:
+            missing_bundles = []
+            for bundle_path, info in bundle_infos.items():
+                if is_bundle_downloaded(info):
+                    scan_queue.put(bundle_path)
+                else:
+                    missing_bundles.append(info)
+
+            if missing_bundles and offline:
+                failed_downloads.update(get_offline_failures(missing_bundles))
+            elif missing_bundles:
+                failed_downloads.update(download_bundles(quality, version, missing_bundles, on_complete=lambda info: scan_queue.put(info['path']), position=1))
+        except Exception as e:
+            failures.append(e)
+        finally:
+            scan_queue.put(None)
+
+    def scan(bundle_path):
+        # Bundles missing from the container index are scanned in the parse pool while the previous ones are matched
+        if bundle_path in known_contents or parse_pool is None:
+            parse_queue.put((bundle_path, None))
+        else:
+            parse_queue.put((bundle_path, parse_pool.submit(scan_bundle, bundle_path)))
+
+    def parse_bundle(item):
+        bundle_path, scanned = item
+        env = None
+        bundle_content = known_contents.get(bundle_path)
+        if scanned is not None:
+            bundle_content = scanned.result()
+            new_contents[bundle_path] = bundle_content
+        elif bundle_content is None and header_only_scan:
+            bundle_content = scan_bundle(bundle_path)
+            new_contents[bundle_path] = bundle_content
+        elif bundle_content is None:
+            env = load_bundle(bundle_path)
+            bundle_content = read_bundle_content(env.container)
+            new_contents[bundle_path] = bundle_content
+
+        mods = match_bundle_mods(bundle_content, mods_files)
+        if not mods:
+            return
+
+        matched_mods[bundle_path] = mods
+        # Bundles built from the same inputs on a previous run are kept as they are
+        if manifest.is_current(bundle_path, mods):
+            pbar.update(len(mods))
+            return
+
+        # Waits for the bundles ahead to be written before loading another one
+        if budget is not None:
+            reserved_memory[bundle_path] = estimate_repack_memory(bundle_path)
+            budget.acquire(reserved_memory[bundle_path])
+
+        # Bundles matched from a scan or the container index are only loaded now that they need rewriting,
+        # by a worker process when there is a pool
+        if env is None and repack_pool is None:
+            env = load_bundle(bundle_path)
+        # Texture encoding is the slowest part of a repack, start it as soon as the match is known
+        encoded_textures = submit_texture_encodes(encoder, texture_futures, mods, bundle_content, quality)
+        repack_queue.put((bundle_path, env, mods, encoded_textures))
+
+    def repack(item):
+        bundle_path, env, mods, encoded_textures = item
+        encoded_textures = get_encoded_textures(encoded_textures)
+        if env is None:
+            modded_bundle_path = str(get_modded_bundle_path(bundle_path))
+            write_queue.put((bundle_path, repack_pool.submit(repack_bundle_file, bundle_path, mods, quality, modded_bundle_path, encoded_textures, get_bundle_compress_threads(workers)), None))
+            return
+
+        # Kept per bundle, the write stage only records bundles repacked without errors
+        bundle_errors = []
+        repack_bundle(env, mods, quality, bundle_errors, pbar, encoded_textures)
+        write_queue.put((bundle_path, env, bundle_errors))
+
+    def release_written():
+        # Runs once the write stage dropped the bundle, so collecting actually frees it
+        if not written_paths:
+            return
+        gc.collect()
+        while written_paths:
+            bundle_path = written_paths.pop()
+            # Encoded textures are dropped with the bundle, a later bundle sharing one gets it from the texture cache
+            for _, mod_filepath in matched_mods[bundle_path]:
+                texture_futures.pop(mod_filepath, None)
+            budget.release(reserved_memory.pop(bundle_path))
+
+    def write(item):
+        bundle_path, result, bundle_errors = item
+        try:
+            write_result(bundle_path, result, bundle_errors)
+        finally:
+            if budget is not None:
+                written_paths.append(bundle_path)
+
+    def write_result(bundle_path, result, bundle_errors):
+        if not isinstance(result, Future):
+            write_modded_bundle(bundle_path, result)
+            errors.extend(bundle_errors)
+            manifest.record_result(bundle_path, matched_mods[bundle_path], bundle_errors)
+            return
+
+        # The worker already wrote the bundle
+        try:
+            replaced_count, bundle_errors = result.result()
+        except Exception as e:
+            replaced_count, bundle_errors = 0, [f" Failed to repack {bundle_path}: {e}"]
+            remove_modded_bundle(bundle_path)
+        pbar.update(replaced_count)
+        errors.extend(bundle_errors)
+        manifest.record_result(bundle_path, matched_mods[bundle_path], bundle_errors)
+
+    with tqdm(desc=" Repacking assets...", ascii=" ##########", bar_format="{desc} {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt}", colour="green", total=len(mods_files), position=0) as pbar:
+        threads = [
+            threading.Thread(target=download_stage, daemon=True),
+            threading.Thread(target=run_stage, args=(scan_queue, parse_queue, scan), daemon=True),
+            threading.Thread(target=run_stage, args=(repack_queue, write_queue, repack), daemon=True),
+            threading.Thread(target=run_stage, args=(write_queue, None, write, release_written), daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            run_stage(parse_queue, repack_queue, parse_bundle)
+            for thread in threads:
+                thread.join()
+            if matched_mods and not failures:
+                manifest.remove_stale()
+        finally:
+            encoder.shutdown(wait=True, cancel_futures=True)
+            if parse_pool is not None:
+                parse_pool.shutdown(wait=True, cancel_futures=True)
+            if repack_pool is not None:
+                repack_pool.shutdown(wait=True, cancel_futures=True)
+            save_container_index(new_contents)
+            manifest.save()
+
+        unmatched_mods = get_unmatched_mods(matched_mods, mods_files)
+        if not failures:
+            pbar.update(len(unmatched_mods))
+
+    if failures:
+        raise failures[0]
+
+    print()
+    report_failed_downloads(failed_downloads, bundle_infos)
+    report_unmatched_mods(unmatched_mods)
+
+    return matched_mods, errors
+
 def convert_json_mods(skip_blurb=False):
     if not skip_blurb:
         clear()
@@ -630,7 +1942,7 @@ if __name__ == "__main__":
                 "message": "RDX Main Menu\n  -------------  ",
                 "pointer": "  >",
                 "qmark": " ",
-                "choices": ["Repack", "Json2Skel Converter (Beta)", "Help", "About", "Ko-Fi", "Github Repository", "Exit"],
+                "choices": ["Repack", "Repack (Offline)", "Json2Skel Converter (Beta)", "Help", "About", "Ko-Fi", "Github Repository", "Exit"],
             }
         ]
     
@@ -660,6 +1972,7 @@ if __name__ == "__main__":
             clear()
             sys.exit(0)
             
+        offline = offline_mode or answer["action"] == "Repack (Offline)"
         print()
         
         # Check necessary folders
@@ -738,35 +2051,53 @@ if __name__ == "__main__":
             continue
         
         print()
-        cdn_version = get_cdn_version(quality)
+        cdn_version = None
+        if not offline:
+            try:
+                cdn_version = get_cdn_version(quality)
+            except Exception:
+                print(" \033[33mCould not reach the maintenance server, repacking from local files.\033[0m")
+                offline = True
+        if offline:
+            cdn_version = get_local_cdn_version(quality)
         
         # -1: Error, 0: Catalog already exists, 1: New Catalog
-        catalog = download_catalog(quality, cdn_version)
+        catalog = download_catalog(quality, cdn_version, offline) if cdn_version else -1
 
-        if catalog == -1:
+        if catalog == -1 and not offline:
+            # Fall back to whatever catalog is already on disk
+            cdn_version = get_local_cdn_version(quality)
+            if cdn_version:
+                print(" \033[33mCould not download bundles catalog, repacking from local files.\033[0m")
+                offline = True
+                catalog = download_catalog(quality, cdn_version, offline)
+
+        if catalog == -1 and offline:
             print()
-            print(" \033[31mCould not download bundles catalog. Aborting.\033[0m")
+            print(f" \033[31mNo local {quality} catalog for the last known game version. Repack online once to download it. Aborting.\033[0m")
             print()
             input(" Press any key...")
             continue
-        
-        skeleton_data_bundles_paths = []
-        old_bundle_names = [f.name for f in asset_bundles_folder_path.iterdir() if f.is_dir()]
-        new_bundle_names = parse_catalog(cdn_version, mods_files.keys())
-
-        if catalog == 1:
-            clean_old_bundles(old_bundle_names, new_bundle_names)
 
-        asset_bundles = parse_asset_bundles()
-    
-        if not asset_bundles:
+        if catalog == -1:
             print()
-            print(" \033[31mNo mods files were found. Aborting.\033[0m")
+            print(" \033[31mCould not download bundles catalog. Aborting.\033[0m")
             print()
             input(" Press any key...")
             continue
+        
+        if catalog == 1:
+            clean_old_catalogs(quality, cdn_version)
 
-        matched_mods = associate_mods_with_bundles(asset_bundles, mods_files)
+        migrate_legacy_bundles()
+        skeleton_data_bundles_paths = []
+        bundle_store_names = {}
+        if pipelined_repack:
+            matched_mods, errors = run_repack_pipeline(quality, cdn_version, mods_files, offline)
+        else:
+            matched_mods, errors = run_staged_repack(quality, cdn_version, mods_files, offline)
+        trim_bundle_store(bundle_store_names)
+        trim_texture_cache()
     
         if not matched_mods:
             print()
@@ -775,8 +2106,6 @@ if __name__ == "__main__":
             input(" Press any key...")
             continue
 
-        errors = replace_files_in_bundles(matched_mods, quality)
-        
         if errors:
             print()
             print(" \033[31mSome files could not be repacked:\033[0m")
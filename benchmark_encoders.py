@@ -0,0 +1,46 @@
+import sys
+import time
+from PIL import Image
+
+import ReDustX
+
+# Compares the texture encoder backends on the png files of the mods folder
+# Usage: python benchmark_encoders.py [HD|SD] [backend ...]
+
+def find_textures():
+    return sorted(path for path in ReDustX.mods_folder_path.rglob("*.png") if path.is_file())
+
+def run_backend(name, textures, block):
+    backend = ReDustX.get_texture_encoder_backend(name)
+    pixels = 0
+    output_size = 0
+    start = time.perf_counter()
+    for texture_path in textures:
+        image = Image.open(texture_path).convert('RGBA')
+        pixels += image.width * image.height
+        output_size += len(backend.encode(texture_path, image, block))
+    return time.perf_counter() - start, pixels, output_size
+
+def main():
+    quality = sys.argv[1] if len(sys.argv) > 1 else "HD"
+    backends = sys.argv[2:] or list(ReDustX.texture_encoder_backends)
+    block = "4x4" if quality == "HD" else "8x8"
+
+    textures = find_textures()
+    if not textures:
+        print(f" No png files found in {ReDustX.mods_folder_path}")
+        return
+
+    _, threads = ReDustX.get_astc_encode_layout()
+    print(f" {len(textures)} textures, block {block}, {threads} thread(s) per texture")
+    print()
+    for name in backends:
+        try:
+            elapsed, pixels, output_size = run_backend(name, textures, block)
+        except Exception as e:
+            print(f" {name}: failed ({e})")
+            continue
+        print(f" {name}: {elapsed:.2f}s, {len(textures) / elapsed:.1f} textures/s, {pixels / elapsed / 1e6:.2f} Mpixels/s, {output_size / 1024 ** 2:.2f} MB output")
+
+if __name__ == "__main__":
+    main()
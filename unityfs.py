@@ -0,0 +1,590 @@
+import io
+import lzma
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from bisect import bisect_right
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import lz4.block
+from UnityPy import config
+from UnityPy.enums import ArchiveFlags, ArchiveFlagsOld, CompressionFlags
+from UnityPy.environment import Environment
+from UnityPy.files import BundleFile, SerializedFile
+from UnityPy.files.BundleFile import DirectoryInfoFS
+from UnityPy.helpers import ImportHelper
+from UnityPy.helpers import CompressionHelper
+from UnityPy.helpers.ContainerHelper import ContainerHelper
+from UnityPy.helpers.UnityVersion import UnityVersion
+from UnityPy.streams import EndianBinaryReader, EndianBinaryWriter
+
+BlockInfo = namedtuple("BlockInfo", "offset size compressed_offset compressed_size flags")
+NodeInfo = namedtuple("NodeInfo", "offset size flags path")
+
+# Nodes holding raw texture and audio payloads, never needed to list a container
+RESOURCE_EXTENSIONS = (".resS", ".resource")
+
+# Data flags and block info flags of each packer, the same UnityPy's BundleFile.save uses.
+# lz4fast isn't one of UnityPy's, it has the flags of lz4 with plain LZ4 blocks
+PACKER_FLAGS = {
+    "none": (64, 64),
+    "lz4": (194, 2),
+    "lz4fast": (194, 2),
+    "lz4hc": (195, 3),
+    "lzma": (65, 1),
+}
+
+# Uncompressed size of a block, lz4 blocks are cut like Unity does and lzma or none use a single block
+LZ4_BLOCK_SIZE = 0x20000
+
+def compress_lz4(data):
+    return lz4.block.compress(data, mode="default", store_size=False)
+
+def compress_lz4hc(data):
+    # Same settings as UnityPy
+    return lz4.block.compress(data, mode="high_compression", compression=9, store_size=False)
+
+# UnityPy compresses both of its lz4 packers with LZ4HC
+PACKER_COMPRESSORS = {
+    "none": bytes,
+    "lz4": compress_lz4hc,
+    "lz4fast": compress_lz4,
+    "lz4hc": compress_lz4hc,
+    "lzma": CompressionHelper.compress_lzma,
+}
+
+def read_string_to_null(file):
+    data = bytearray()
+    while True:
+        c = file.read(1)
+        if not c:
+            raise ValueError("Unterminated string in bundle header")
+        if c == b"\0":
+            return data.decode("utf8", "surrogateescape")
+        data += c
+
+def parse_engine_version(version_engine):
+    try:
+        version = UnityVersion.from_str(version_engine)
+    except ValueError:
+        version = None
+    if version is None or version.major == 0:
+        version = UnityVersion.from_str(config.get_fallback_version())
+    return version
+
+def uses_old_archive_flags(version):
+    # Same rule as UnityPy, the 0x200 flag meant encryption before the alignment fix
+    return (
+        version < (2020,)
+        or (version[0] == 2020 and version < (2020, 3, 34))
+        or (version[0] == 2021 and version < (2021, 3, 2))
+        or (version[0] == 2022 and version < (2022, 1, 1))
+    )
+
+def decompress_block(data, size, flags):
+    compression = CompressionFlags(flags & ArchiveFlags.CompressionTypeMask)
+    if compression not in CompressionHelper.DECOMPRESSION_MAP:
+        raise ValueError(f"Unknown compression flag {flags}")
+    return CompressionHelper.DECOMPRESSION_MAP[compression](data, size)
+
+class UnityFSFile:
+    # UnityFS bundle read from its header and block table, blocks are only decompressed when a read needs them
+    def __init__(self, file, cached_blocks=8):
+        self.file = file
+        self.cached_blocks = cached_blocks
+        self.blocks_cache = OrderedDict()
+        self.decompressed_blocks = 0
+
+        signature = read_string_to_null(file)
+        if signature != "UnityFS":
+            raise ValueError(f"Not a UnityFS bundle: {signature}")
+        self.format_version = struct.unpack(">I", file.read(4))[0]
+        self.version_player = read_string_to_null(file)
+        self.version_engine = read_string_to_null(file)
+        self.size, compressed_size, uncompressed_size, flags = struct.unpack(">qIII", file.read(20))
+
+        version = parse_engine_version(self.version_engine)
+        old_flags = uses_old_archive_flags(version)
+        self.dataflags = ArchiveFlagsOld(flags) if old_flags else ArchiveFlags(flags)
+        if self.dataflags & self.dataflags.UsesAssetBundleEncryption:
+            raise NotImplementedError("Encrypted bundles can't be scanned from their header")
+
+        self.block_alignment = self.format_version >= 7 or (version[0] == 2019 and version >= (2019, 4, 15))
+        if self.block_alignment:
+            self.align(16)
+
+        start = file.tell()
+        if flags & ArchiveFlags.BlocksInfoAtTheEnd:
+            file.seek(-compressed_size, io.SEEK_END)
+            blocks_info = file.read(compressed_size)
+            file.seek(start)
+        else:
+            blocks_info = file.read(compressed_size)
+        blocks_info = memoryview(decompress_block(blocks_info, uncompressed_size, flags))
+
+        position = 16  # Uncompressed data hash
+        blocks_count = struct.unpack_from(">i", blocks_info, position)[0]
+        position += 4
+        raw_blocks = [struct.unpack_from(">IIH", blocks_info, position + i * 10) for i in range(blocks_count)]
+        position += blocks_count * 10
+
+        nodes_count = struct.unpack_from(">i", blocks_info, position)[0]
+        position += 4
+        self.nodes = []
+        for _ in range(nodes_count):
+            offset, size, node_flags = struct.unpack_from(">qqI", blocks_info, position)
+            end = bytes(blocks_info[position + 20:]).index(b"\0")
+            path = bytes(blocks_info[position + 20:position + 20 + end]).decode("utf8", "surrogateescape")
+            position += 20 + end + 1
+            self.nodes.append(NodeInfo(offset, size, node_flags, path))
+
+        if not old_flags and flags & ArchiveFlags.BlockInfoNeedPaddingAtStart:
+            self.align(16)
+
+        self.blocks = []
+        uncompressed_offset = 0
+        compressed_offset = file.tell()
+        for block_size, block_compressed_size, block_flags in raw_blocks:
+            self.blocks.append(BlockInfo(uncompressed_offset, block_size, compressed_offset, block_compressed_size, block_flags))
+            uncompressed_offset += block_size
+            compressed_offset += block_compressed_size
+        self.block_starts = [block.offset for block in self.blocks]
+        self.length = uncompressed_offset
+
+    def align(self, alignment):
+        position = self.file.tell()
+        self.file.seek((alignment - position % alignment) % alignment, io.SEEK_CUR)
+
+    def get_block(self, index):
+        if index in self.blocks_cache:
+            self.blocks_cache.move_to_end(index)
+            return self.blocks_cache[index]
+
+        block = self.blocks[index]
+        self.file.seek(block.compressed_offset)
+        data = decompress_block(self.file.read(block.compressed_size), block.size, block.flags)
+        self.decompressed_blocks += 1
+
+        self.blocks_cache[index] = data
+        while len(self.blocks_cache) > self.cached_blocks:
+            self.blocks_cache.popitem(last=False)
+        return data
+
+    def read_raw_block(self, index):
+        block = self.blocks[index]
+        self.file.seek(block.compressed_offset)
+        return self.file.read(block.compressed_size)
+
+    def read_into(self, offset, buffer):
+        view = memoryview(buffer).cast("B")
+        count = min(len(view), self.length - offset)
+        written = 0
+        while written < count:
+            index = bisect_right(self.block_starts, offset + written) - 1
+            block = self.blocks[index]
+            data = self.get_block(index)
+            block_offset = offset + written - block.offset
+            size = min(count - written, block.size - block_offset)
+            view[written:written + size] = data[block_offset:block_offset + size]
+            written += size
+        return written
+
+    def map_data(self, view):
+        # All the uncompressed data, a slice of view (the whole file) when every block is stored as it is,
+        # otherwise each block is decompressed once into a single buffer
+        stored = all(block.flags & ArchiveFlags.CompressionTypeMask == CompressionFlags.NONE for block in self.blocks)
+        if stored:
+            start = self.blocks[0].compressed_offset if self.blocks else 0
+            return view[start:start + self.length]
+
+        data = bytearray(self.length)
+        self.read_into(0, data)
+        return memoryview(data)
+
+    def open_node(self, node):
+        return io.BufferedReader(NodeStream(self, node), buffer_size=0x10000)
+
+class NodeStream(io.RawIOBase):
+    # Seekable window over one node of the uncompressed block data
+    def __init__(self, bundle, node):
+        self.bundle = bundle
+        self.node = node
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.node.size + offset
+        return self.position
+
+    def readinto(self, buffer):
+        size = max(0, min(len(buffer), self.node.size - self.position))
+        if not size:
+            return 0
+        read = self.bundle.read_into(self.node.offset + self.position, memoryview(buffer)[:size])
+        self.position += read
+        return read
+
+class MappedBundleFile(BundleFile):
+    # UnityPy BundleFile over a memory-mapped bundle. UnityPy joins the decompressed blocks and then
+    # copies every node out of them, here the nodes are views of map_data instead
+    def __init__(self, mapped, parent, name=None, **kwargs):
+        self.mapped = mapped
+        super().__init__(EndianBinaryReader(memoryview(mapped)), parent, name=name, **kwargs)
+
+    def read_fs(self, reader):
+        self.mapped.seek(0)
+        bundle = UnityFSFile(self.mapped)
+        self.dataflags = bundle.dataflags
+        self._uses_block_alignment = bundle.block_alignment
+        if bundle.blocks:
+            self._block_info_flags = bundle.blocks[0].flags
+        directory = [DirectoryInfoFS(node.offset, node.size, node.flags, node.path) for node in bundle.nodes]
+        return directory, bundle.map_data(memoryview(self.mapped))
+
+    def read_files(self, data, files):
+        # Same as UnityPy's File.read_files, without copying the node data
+        for node in files:
+            node_reader = EndianBinaryReader(data[node.offset:node.offset + node.size], offset=node.offset)
+            f = ImportHelper.parse_file(node_reader, self, node.path, is_dependency=self.is_dependency)
+            if isinstance(f, (EndianBinaryReader, SerializedFile)) and self.environment:
+                self.environment.register_cab(node.path, f)
+            f.flags = node.flags
+            self.files[node.path] = f
+
+def load_bundle(file_path):
+    # Same environment as UnityPy.load(file_path), read from a memory-mapped view of the file.
+    # The mapping stays open as long as the environment uses it
+    file_path = str(file_path)
+    with open(file_path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    env = Environment(path=os.path.dirname(file_path))
+    env.files[file_path] = MappedBundleFile(mapped, env, name=file_path)
+    env.file = env.files[file_path]
+    return env
+
+def read_bundle_container(file_path):
+    # Same entries as UnityPy.load(file_path).container, without decompressing texture payloads
+    with open(file_path, "rb") as f:
+        bundle = UnityFSFile(f)
+        container = []
+        for node in bundle.nodes:
+            if node.path.endswith(RESOURCE_EXTENSIONS):
+                continue
+            reader = EndianBinaryReader(bundle.open_node(node))
+            serialized_file = SerializedFile(reader, name=node.path)
+            container.extend(serialized_file.container.container)
+
+    return ContainerHelper(container)
+
+def create_lzma_compressor():
+    # Incremental version of UnityPy's compress_lzma, the data is never held in memory at once
+    return lzma.LZMACompressor(format=lzma.FORMAT_RAW, filters=[{
+        "id": lzma.FILTER_LZMA1,
+        "dict_size": 0x800000,
+        "lc": 3,
+        "lp": 0,
+        "pb": 2,
+        "mode": lzma.MODE_NORMAL,
+        "mf": lzma.MF_BT4,
+        "nice_len": 123,
+    }])
+
+class BlockWriter:
+    # Cuts the bundle data into blocks and writes each one as soon as it is complete.
+    # lz4 blocks are independent, with several threads they are compressed in parallel
+    # (lz4 releases the GIL) and still written in order, so the output doesn't change
+    def __init__(self, file, block_info_flag, compress, threads=1):
+        self.file = file
+        self.flag = block_info_flag
+        self.compress = compress
+        self.compression = CompressionFlags(block_info_flag & ArchiveFlags.CompressionTypeMask)
+        self.blocks = []
+        self.pending = bytearray()
+        self.size = 0
+        self.compressed_size = 0
+        self.executor = None
+        self.compressing = deque()
+        self.max_compressing = threads * 2  # Enough queued blocks to keep every thread busy
+        if threads > 1 and self.compression in (CompressionFlags.LZ4, CompressionFlags.LZ4HC):
+            self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.lzma_compressor = create_lzma_compressor() if self.compression == CompressionFlags.LZMA else None
+        self.lzma_raw_file = None
+        if self.lzma_compressor:
+            # The single lzma block is stored raw if it doesn't shrink, so the input is kept on disk until then
+            self.start = file.tell()
+            self.lzma_raw_file = tempfile.TemporaryFile()
+            self.write_compressed(struct.pack("<BI", 0x5D, 0x800000))
+
+    def write_compressed(self, data):
+        self.file.write(data)
+        self.compressed_size += len(data)
+
+    def write(self, data):
+        view = memoryview(data).cast("B")
+        self.size += len(view)
+        if self.compression == CompressionFlags.NONE:
+            self.write_compressed(view)
+            return
+        if self.lzma_compressor:
+            self.lzma_raw_file.write(view)
+            self.write_compressed(self.lzma_compressor.compress(view))
+            return
+
+        # Full blocks are compressed straight from the node data, only the tail is buffered
+        position = 0
+        if self.pending:
+            position = min(len(view), LZ4_BLOCK_SIZE - len(self.pending))
+            self.pending += view[:position]
+            if len(self.pending) < LZ4_BLOCK_SIZE:
+                return
+            self.write_block(self.pending)
+            self.pending = bytearray()
+        while len(view) - position >= LZ4_BLOCK_SIZE:
+            self.write_block(view[position:position + LZ4_BLOCK_SIZE])
+            position += LZ4_BLOCK_SIZE
+        self.pending += view[position:]
+
+    def write_block(self, data):
+        if self.executor is None:
+            self.write_compressed_block(data, self.compress(data))
+            return
+
+        self.compressing.append((data, self.executor.submit(self.compress, data)))
+        while len(self.compressing) > self.max_compressing:
+            self.write_next_block()
+
+    def write_next_block(self):
+        data, future = self.compressing.popleft()
+        self.write_compressed_block(data, future.result())
+
+    def write_compressed_block(self, data, compressed):
+        # Blocks that don't shrink are stored as they are, like UnityPy does: a full block
+        # compressed to its own size is stored raw, the last block only when it grows
+        if len(compressed) > len(data) or len(compressed) == len(data) == LZ4_BLOCK_SIZE:
+            self.write_compressed(data)
+            self.blocks.append((len(data), len(data), self.flag ^ self.compression))
+        else:
+            self.write_compressed(compressed)
+            self.blocks.append((len(data), len(compressed), self.flag))
+
+    def copy_block(self, data, size, flag):
+        # Block taken as it is from another bundle, only for lz4 packers whose blocks stand on their own
+        self.flush()
+        self.write_compressed(data)
+        self.size += size
+        self.blocks.append((size, len(data), flag))
+
+    def flush(self):
+        if self.pending:
+            self.write_block(self.pending)
+            self.pending = bytearray()
+        while self.compressing:
+            self.write_next_block()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+        if self.lzma_raw_file is not None:
+            self.lzma_raw_file.close()
+
+    def close(self):
+        if self.compression == CompressionFlags.NONE:
+            self.blocks.append((self.size, self.size, self.flag))
+        elif self.lzma_compressor:
+            self.write_compressed(self.lzma_compressor.flush())
+            if self.compressed_size > self.size:
+                self.file.seek(self.start)
+                self.file.truncate()
+                self.lzma_raw_file.seek(0)
+                shutil.copyfileobj(self.lzma_raw_file, self.file, 0x100000)
+                self.compressed_size = self.size
+                self.blocks.append((self.size, self.size, self.flag ^ self.compression))
+            else:
+                self.blocks.append((self.size, self.compressed_size, self.flag))
+        else:
+            self.flush()
+        return self.blocks
+
+def get_node_data(node):
+    if isinstance(node, (EndianBinaryReader, EndianBinaryWriter)):
+        return node.bytes
+    return node.save()
+
+def build_blocks_info(blocks, nodes):
+    writer = EndianBinaryWriter(b"\x00" * 0x10)  # Uncompressed data hash
+    writer.write_int(len(blocks))
+    for size, compressed_size, flag in blocks:
+        writer.write_u_int(size)
+        writer.write_u_int(compressed_size)
+        writer.write_u_short(flag)
+    writer.write_int(len(nodes))
+    for offset, size, flag, path in nodes:
+        writer.write_long(offset)
+        writer.write_long(size)
+        writer.write_u_int(flag)
+        writer.write_string_to_null(path)
+    return writer.bytes
+
+def write_nodes(bundle_file, block_writer):
+    nodes = []
+    offset = 0
+    for path, node in bundle_file.files.items():
+        # One node is serialized at a time and released once its blocks are written
+        data = get_node_data(node)
+        block_writer.write(data)
+        nodes.append((offset, len(data), node.flags, path))
+        offset += len(data)
+        del data
+    return block_writer.close(), nodes
+
+class NodesData:
+    # Serialized nodes of the new bundle, read as one continuous stream
+    def __init__(self, bundle_file):
+        self.nodes = []
+        self.datas = []
+        offset = 0
+        for path, node in bundle_file.files.items():
+            data = memoryview(get_node_data(node)).cast("B")
+            self.nodes.append((offset, len(data), node.flags, path))
+            self.datas.append(data)
+            offset += len(data)
+        self.starts = [node[0] for node in self.nodes]
+        self.length = offset
+
+    def iter_range(self, start, end):
+        index = bisect_right(self.starts, start) - 1
+        while start < end:
+            offset = self.starts[index]
+            data = self.datas[index]
+            piece = data[start - offset:min(end - offset, len(data))]
+            yield piece
+            start += len(piece)
+            index += 1
+
+    def read(self, start, size):
+        return b"".join(self.iter_range(start, start + size))
+
+def find_reusable_blocks(original, nodes_data):
+    # Unchanged bytes of a node sit at the same distance from its start before the first modified
+    # object, and from its end after the last one, so each block is looked for at those two shifts
+    original_nodes = {node.path: node for node in original.nodes}
+    node_shifts = []
+    for offset, size, _, path in nodes_data.nodes:
+        node = original_nodes.get(path)
+        if node is not None:
+            node_shifts.append((node.offset, node.offset + node.size, (offset - node.offset, offset + size - node.offset - node.size)))
+
+    reusable = []
+    end = 0
+    for index, block in enumerate(original.blocks):
+        shifts = []
+        for node_start, node_end, node_shift in node_shifts:
+            if node_start < block.offset + block.size and block.offset < node_end:
+                shifts.extend(shift for shift in node_shift if shift not in shifts)
+        for shift in shifts:
+            start = block.offset + shift
+            if start < end or start + block.size > nodes_data.length:
+                continue
+            # Only reused when every byte matches
+            if nodes_data.read(start, block.size) == original.get_block(index):
+                reusable.append((start, index))
+                end = start + block.size
+                break
+    return reusable
+
+def write_nodes_preserving(bundle_file, block_writer, original):
+    nodes_data = NodesData(bundle_file)
+    position = 0
+    for start, index in find_reusable_blocks(original, nodes_data):
+        for piece in nodes_data.iter_range(position, start):
+            block_writer.write(piece)
+        block = original.blocks[index]
+        block_writer.copy_block(original.read_raw_block(index), block.size, block.flags)
+        position = start + block.size
+    for piece in nodes_data.iter_range(position, nodes_data.length):
+        block_writer.write(piece)
+    return block_writer.close(), nodes_data.nodes
+
+def open_original_bundle(file):
+    # Bundles the reader doesn't handle are simply compressed again
+    try:
+        return UnityFSFile(file)
+    except (ValueError, NotImplementedError):
+        return None
+
+def align_file(file, alignment):
+    file.write(b"\x00" * ((alignment - file.tell() % alignment) % alignment))
+
+def write_bundle(bundle_file, file, packer="lz4", original_path=None, threads=1):
+    # Same layout as bundle_file.save(packer), written block by block instead of built in memory first.
+    # With original_path, blocks of that bundle left untouched are copied instead of compressed again,
+    # and threads compress several blocks at once (lz4 packers only)
+    if bundle_file.signature != "UnityFS":
+        file.write(bundle_file.save(packer="lz4" if packer == "lz4fast" else packer))
+        return
+    if packer not in PACKER_FLAGS:
+        raise ValueError(f"Unknown packer {packer}, use one of: {', '.join(PACKER_FLAGS)}")
+    data_flag, block_info_flag = PACKER_FLAGS[packer]
+
+    start = file.tell()
+    file.write(bundle_file.signature.encode() + b"\0")
+    file.write(struct.pack(">I", bundle_file.version))
+    file.write(bundle_file.version_player.encode() + b"\0")
+    file.write(bundle_file.version_engine.encode() + b"\0")
+    header_position = file.tell()
+    file.write(bytes(20))  # Sizes are only known once the blocks are written
+    if bundle_file._uses_block_alignment:
+        align_file(file, 16)
+
+    compress = PACKER_COMPRESSORS[packer]
+    if data_flag & ArchiveFlags.BlocksInfoAtTheEnd:
+        block_writer = BlockWriter(file, block_info_flag, compress, threads)
+        try:
+            if original_path is None:
+                blocks, nodes = write_nodes(bundle_file, block_writer)
+            else:
+                with open(original_path, "rb") as original_file:
+                    original = open_original_bundle(original_file)
+                    if original is None:
+                        blocks, nodes = write_nodes(bundle_file, block_writer)
+                    else:
+                        blocks, nodes = write_nodes_preserving(bundle_file, block_writer, original)
+        finally:
+            block_writer.shutdown()
+        blocks_info = build_blocks_info(blocks, nodes)
+        compressed_blocks_info = compress(blocks_info)
+        file.write(compressed_blocks_info)
+    else:
+        # The blocks info comes first, the blocks wait in a temporary file until their sizes are known
+        with tempfile.TemporaryFile() as blocks_file:
+            block_writer = BlockWriter(blocks_file, block_info_flag, compress)
+            try:
+                blocks, nodes = write_nodes(bundle_file, block_writer)
+            finally:
+                block_writer.shutdown()
+            blocks_info = build_blocks_info(blocks, nodes)
+            compressed_blocks_info = compress(blocks_info)
+            file.write(compressed_blocks_info)
+            blocks_file.seek(0)
+            shutil.copyfileobj(blocks_file, file, 0x100000)
+
+    end = file.tell()
+    file.seek(header_position)
+    file.write(struct.pack(">qIII", end - start, len(compressed_blocks_info), len(blocks_info), data_flag))
+    file.seek(end)